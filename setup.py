@@ -34,7 +34,8 @@ setup(
         'zopectl.command': [
             'testsetup = org.bccvl.testsetup.main:zopectl',
             'manage = org.bccvl.testsetup.manage:zopectl',
-            'datasetcleanup = org.bccvl.testsetup.datasetcleanup:zopectl'
+            'datasetcleanup = org.bccvl.testsetup.datasetcleanup:zopectl',
+            'bccvl = org.bccvl.testsetup.commands:zopectl',
         ]
     }
 )
@@ -0,0 +1,85 @@
+""" Catalogue of datasets provided by the import sources
+
+The datasets are listed in catalogue.json per source. Each source has a
+list of blocks; a block maps dimensions (emsc, gcm, year, ...) to lists
+of values and stands for all combinations of them.
+
+The catalogue is expanded into rows and indexed by source and dimension
+value on first use, so that a filtered selection only visits matching
+rows.
+"""
+from itertools import product
+import json
+
+from pkg_resources import resource_stream
+
+
+# order in which dimensions of a block are expanded
+DIMENSIONS = ('emsc', 'gcm', 'year', 'resolution', 'layer')
+
+
+def _dimension_order(name):
+    if name in DIMENSIONS:
+        return (DIMENSIONS.index(name), name)
+    return (len(DIMENSIONS), name)
+
+
+class DatasetIndex(object):
+
+    def __init__(self, catalogue):
+        # source -> list of rows
+        self.rows = {}
+        # source -> set of dimension names
+        self.dimensions = {}
+        # (source, dimension, value) -> set of row numbers
+        self.index = {}
+        for source, blocks in catalogue.items():
+            rows = self.rows.setdefault(source, [])
+            dimensions = self.dimensions.setdefault(source, set())
+            for block in blocks:
+                names = sorted(block, key=_dimension_order)
+                dimensions.update(names)
+                values = [block[name] if isinstance(block[name], list)
+                          else [block[name]] for name in names]
+                for combination in product(*values):
+                    row = dict(zip(names, combination))
+                    for name, value in row.items():
+                        self.index.setdefault(
+                            (source, name, value), set()).add(len(rows))
+                    rows.append(row)
+
+    def select(self, source, **filters):
+        """Return rows of source matching all filters
+
+        Each filter is a collection of accepted values for a dimension.
+        Empty filters and filters on dimensions the source doesn't have
+        are ignored.
+        """
+        rows = self.rows.get(source, [])
+        dimensions = self.dimensions.get(source, ())
+        selected = None
+        for name, values in filters.items():
+            if not values or name not in dimensions:
+                continue
+            matches = set()
+            for value in values:
+                matches.update(self.index.get((source, name, value), ()))
+            selected = matches if selected is None else selected & matches
+        if selected is None:
+            return list(rows)
+        return [rows[num] for num in sorted(selected)]
+
+
+_index = None
+
+
+def get_index():
+    """Return the index over catalogue.json, built on first use"""
+    global _index
+    if _index is None:
+        stream = resource_stream(__name__, 'catalogue.json')
+        try:
+            _index = DatasetIndex(json.load(stream))
+        finally:
+            stream.close()
+    return _index
@@ -0,0 +1,86 @@
+""" call this with:
+    ./bin/instance bccvl manage --upgrade -- import --all -- cleanup
+
+    Runs the given commands one after the other within a single Zope
+    startup. Each command takes the same options as its own zopectl
+    command (manage, testsetup, datasetcleanup); commands are separated
+    by '--'.
+
+    make sure ./bin/instance is down while doing this, unless the only
+    command is 'import --online'
+"""
+import logging
+import sys
+import time
+
+from org.bccvl.testsetup import datasetcleanup
+from org.bccvl.testsetup import main
+from org.bccvl.testsetup import manage
+from org.bccvl.testsetup.utils import prepare_app, setup_logging
+
+
+LOG = logging.getLogger('org.bccvl.testsetup')
+
+# command name -> module with parse_args and run
+COMMANDS = {
+    'manage': manage,
+    'import': main,
+    'cleanup': datasetcleanup,
+}
+
+
+def split_commands(args):
+    """Split args at '--' into a list of (command, args) tuples"""
+    commands = []
+    current = []
+    for arg in list(args) + ['--']:
+        if arg != '--':
+            current.append(arg)
+            continue
+        if current:
+            if current[0] not in COMMANDS:
+                raise ValueError('Unknown command {0}, expected one of {1}'.format(
+                    current[0], ', '.join(sorted(COMMANDS))))
+            commands.append((current[0], current[1:]))
+        current = []
+    return commands
+
+
+def run(app, commands):
+    """Run parsed commands against app and return timing per command"""
+    app = prepare_app(app)
+    timings = []
+    for name, params in commands:
+        LOG.info('Running %s', name)
+        start = time.time()
+        COMMANDS[name].run(app, params)
+        timings.append((name, time.time() - start))
+        LOG.info('Finished %s in %.1fs', name, timings[-1][1])
+    for name, elapsed in timings:
+        LOG.info('%-10s %8.1fs', name, elapsed)
+    LOG.info('%-10s %8.1fs', 'total', sum(elapsed for name, elapsed in timings))
+    return timings
+
+
+def zopectl(app, args):
+    """ zopectl entry point
+    app ... the Zope root Application
+    args ... list of command line args passed (very similar to sys.argv)
+             args[0] ... name of script but is always '-c'
+             args[1] ... name of entry point
+             args[2:] ... commands and their args separated by '--'
+    """
+    # get rid of '-c'
+    if args[0] == '-c':
+        args.pop(0)
+    setup_logging()
+    # parse all args before doing anything
+    commands = [(name, COMMANDS[name].parse_args(cmdargs))
+                for name, cmdargs in split_commands(args[1:])]
+    run(app, commands)
+
+
+if 'app' in locals():
+    # we have been started via ./bin/instance run commands.py
+    # but ideally should be run via ./bin/instance bccvl
+    zopectl(app, sys.argv[3:])
@@ -3,92 +3,369 @@
 
     make sure ./bin/instance is down while doing this
 """
+import os
+import posixpath
+import re
 import sys
 import logging
-from AccessControl.SecurityManagement import newSecurityManager
-from AccessControl.SpecialUsers import system
-from Testing.makerequest import makerequest
 import transaction
-from AccessControl.SecurityManager import setSecurityPolicy
-from Products.CMFCore.tests.base.security import PermissiveSecurityPolicy, OmnipotentUser
 from collective.transmogrifier.transmogrifier import Transmogrifier
 import argparse
-from org.bccvl.site.content.interfaces import IDataset
+from org.bccvl.site.content.interfaces import IDataset, IExperiment
+from plone.dexterity.utils import iterSchemata
+from zope.schema import getFieldsInOrder
 from org.bccvl.site import defaults
+from org.bccvl.testsetup.remote import RemoteClient, archive_objects, delete_objects, swift_path
+from org.bccvl.testsetup.transmogrify import SWIFTROOT
+from org.bccvl.testsetup.utils import prepare_app, setup_logging, site
 from Products.CMFCore.utils import getToolByName
 
 
 # TODO: if item/file id already exists, then just updload/update metadata
-try:
-    from zope.component.hooks import site
-except ImportError:
-    # we have an older zope.compenents:
-    import contextlib
-    from zope.component.hooks import getSite, setSite
-
-    @contextlib.contextmanager
-    def site(site):
-        old_site = getSite()
-        setSite(site)
-        try:
-            yield
-        finally:
-            setSite(old_site)
 
 LOG = logging.getLogger('org.bccvl.testsetup')
 
 
-def cleanup_dataset(site, params):
-    # Delete datasets that are marked as REMOVED and are not referenced by experiment
+# plone uuids are uuid4 hex strings
+UUID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def find_uuids(value, found):
+    """Add all uuid like strings within value to found"""
+    if isinstance(value, basestring):
+        if UUID_RE.match(value):
+            found.add(value)
+    elif hasattr(value, 'items'):
+        for key, val in value.items():
+            find_uuids(key, found)
+            find_uuids(val, found)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for val in value:
+            find_uuids(val, found)
+
+
+def build_reference_index(site):
+    """Return a dict mapping dataset uuids to paths of experiments using them
+
+    Every field of every experiment is searched once for uuids, so that
+    checking whether a dataset is in use is a simple lookup afterwards.
+    """
+    pc = getToolByName(site, 'portal_catalog')
+    experiments = site[defaults.EXPERIMENTS_FOLDER_ID]
+    index = {}
+    count = 0
+    for brain in pc.unrestrictedSearchResults(object_provides=IExperiment.__identifier__,
+                                              path='/'.join(experiments.getPhysicalPath())):
+        exp = brain._unrestrictedGetObject()
+        found = set()
+        for schema in iterSchemata(exp):
+            for name, field in getFieldsInOrder(schema):
+                find_uuids(getattr(exp, name, None), found)
+        for uuid in found:
+            index.setdefault(uuid, []).append(brain.getPath())
+        count += 1
+        if count % 1000 == 0:
+            # don't keep all experiments in memory
+            site._p_jar.cacheGC()
+    LOG.info("Indexed %d datasets referenced by %d experiments", len(index), count)
+    return index
+
+
+def delete_datasets(site, parentpath, entries):
+    """Delete the (path, title) entries within folder parentpath in one go"""
+    parent = site.unrestrictedTraverse(parentpath, None)
+    if parent is None:
+        # gone already
+        return
+    ids = [posixpath.basename(path) for path, title in entries]
+    ids = [dsid for dsid in ids if parent.hasObject(dsid)]
+    if not ids:
+        return
+    LOG.info("Deleting %d datasets from %s", len(ids), parentpath)
+    parent.manage_delObjects(ids)
+
+
+def delete_isolated(site, parentpath, entries):
+    """Delete entries one by one, rolling back each one that fails
+
+    Returns the entries which could not be deleted.
+    """
+    failed = []
+    for entry in entries:
+        savepoint = transaction.savepoint(optimistic=True)
+        try:
+            delete_datasets(site, parentpath, [entry])
+        except Exception:
+            LOG.exception("Failed to delete dataset %s", entry[0])
+            savepoint.rollback()
+            failed.append(entry)
+    return failed
+
+
+def delete_chunk(site, chunk):
+    """Delete the (path, title) entries in chunk within one transaction
+
+    Datasets are deleted with one manage_delObjects per parent folder,
+    working from catalog data only. If that fails, the folder's datasets
+    are deleted again one by one within savepoints, so that only the
+    failing ones are rolled back and the rest of the chunk gets committed.
+    If the commit itself fails, the chunk is deleted again one dataset per
+    transaction. Returns the entries which could not be deleted.
+    """
+    groups = {}
+    for entry in chunk:
+        groups.setdefault(posixpath.dirname(entry[0]), []).append(entry)
+
+    failed = []
+    for parentpath, entries in sorted(groups.items()):
+        savepoint = transaction.savepoint(optimistic=True)
+        try:
+            delete_datasets(site, parentpath, entries)
+        except Exception:
+            LOG.exception("Failed to delete %d datasets from %s",
+                          len(entries), parentpath)
+            savepoint.rollback()
+            if len(entries) > 1:
+                failed.extend(delete_isolated(site, parentpath, entries))
+            else:
+                failed.extend(entries)
+    try:
+        transaction.commit()
+    except Exception:
+        transaction.abort()
+        if len(chunk) == 1:
+            LOG.exception("Failed to commit delete of dataset %s", chunk[0][0])
+            return list(chunk)
+        LOG.exception("Failed to commit chunk of %d datasets, deleting them "
+                      "one by one", len(chunk))
+        for entry in chunk:
+            if entry not in failed:
+                failed.extend(delete_chunk(site, [entry]))
+    return failed
+
+
+# units used by the getObjSize catalog metadata
+SIZE_UNITS = {
+    'B': 1,
+    'KB': 1024,
+    'MB': 1024 ** 2,
+    'GB': 1024 ** 3,
+    'TB': 1024 ** 4,
+}
+
+
+def parse_size(size):
+    """Return number of bytes for a human readable size like '1.2 MB'"""
+    try:
+        value, unit = size.split()
+        return int(float(value) * SIZE_UNITS[unit.upper()])
+    except (AttributeError, KeyError, ValueError):
+        return 0
+
+
+REMOTE_DATASET_TYPE = 'org.bccvl.content.remotedataset'
+
+
+def brain_remote_url(brain):
+    """Return remote url of a remote dataset from catalog metadata
+
+    Returns None if the catalog has no url for brain. Callers count remote
+    datasets without one, as their remote objects can't be cleaned up.
+    """
+    url = getattr(brain, 'getRemoteUrl', None) or getattr(brain, 'remoteUrl', None)
+    if isinstance(url, basestring) and url:
+        return url
+    return None
+
+
+def remote_urls_in_use(site, exclude=()):
+    """Return remote urls of all datasets in the catalog
+
+    Datasets at paths in exclude are left out. Imported datasets share
+    fixed urls, so an object may still be used after one of its datasets
+    has been removed.
+    """
     pc = getToolByName(site, 'portal_catalog')
+    urls = set()
+    for brain in pc.unrestrictedSearchResults(object_provides=IDataset.__identifier__):
+        if brain.getPath() in exclude:
+            continue
+        url = brain_remote_url(brain)
+        if url:
+            urls.add(url)
+    return urls
 
-    trcounter = 0
+
+def removed_datasets(site, references):
+    """Generate brains of REMOVED datasets not referenced by an experiment"""
+    pc = getToolByName(site, 'portal_catalog')
     datasets = site[defaults.DATASETS_FOLDER_ID]
     for brain in pc.unrestrictedSearchResults(object_provides=IDataset.__identifier__,
                                               path='/'.join(datasets.getPhysicalPath()),
                                               job_state='REMOVED'):
-        # Fix me: Do a commit on every single delete as some dataset has invalid url.
-        # Shall fix the dataset URL, then can commit a series of deletes.
-        ds = brain.getObject()
-        LOG.info("Deleting datasets %s", brain.Title)
-        ds.aq_parent.manage_delObjects([ds.getId()])
-        transaction.commit()
-    return
+        if brain.UID in references:
+            LOG.info("Keeping dataset %s, used by %d experiments",
+                     brain.Title, len(references[brain.UID]))
+            continue
+        yield brain
 
-def spoofRequest(app):
-    """
-    Make REQUEST variable to be available on the Zope application server.
 
-    This allows acquisition to work properly
+def report_cleanup(site, params):
+    """Report what cleanup_dataset would delete, grouped by dataset folder
+
+    Works from catalog metadata only. Sizes are the rounded getObjSize
+    values; remote urls are listed where the catalog has them, remote
+    datasets without one are counted as ``nourl``, and those whose url
+    is still used by another dataset as ``inuse``.
     """
-    _policy = PermissiveSecurityPolicy()
-    _oldpolicy = setSecurityPolicy(_policy)
-    newSecurityManager(None, OmnipotentUser().__of__(app.acl_users))
-    return makerequest(app)
+    datasets_path = '/'.join(site[defaults.DATASETS_FOLDER_ID].getPhysicalPath())
+    brains = list(removed_datasets(site, build_reference_index(site)))
+    inuse = remote_urls_in_use(site, set(brain.getPath() for brain in brains))
+    folders = {}
+    for brain in brains:
+        folder = posixpath.dirname(brain.getPath())[len(datasets_path) + 1:]
+        stats = folders.setdefault(folder or '.', {'count': 0, 'bytes': 0,
+                                                   'urls': [], 'nourl': 0,
+                                                   'inuse': 0})
+        stats['count'] += 1
+        stats['bytes'] += parse_size(getattr(brain, 'getObjSize', None))
+        url = brain_remote_url(brain)
+        if url in inuse:
+            stats['inuse'] += 1
+        elif url:
+            stats['urls'].append(url)
+        elif brain.portal_type == REMOTE_DATASET_TYPE:
+            stats['nourl'] += 1
 
-def main(app, params):
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
+    LOG.info('%-40s %8s %14s %8s', 'folder', 'datasets', 'bytes', 'remote')
+    total = {'count': 0, 'bytes': 0, 'urls': 0}
+    for folder, stats in sorted(folders.items()):
+        LOG.info('%-40s %8d %14d %8d', folder, stats['count'], stats['bytes'],
+                 len(stats['urls']))
+        for url in stats['urls']:
+            LOG.info('    %s', url)
+        total['count'] += stats['count']
+        total['bytes'] += stats['bytes']
+        total['urls'] += len(stats['urls'])
+    LOG.info('%-40s %8d %14d %8d', 'total', total['count'], total['bytes'],
+             total['urls'])
+    inuse = sum(stats['inuse'] for stats in folders.values())
+    if inuse:
+        LOG.info('%d remote objects are kept, other datasets still use them',
+                 inuse)
+    nourl = sum(stats['nourl'] for stats in folders.values())
+    if nourl:
+        LOG.warning('%d remote datasets have no remote url in the catalog; '
+                    'their remote objects are not listed', nourl)
+    return folders
+
+
+def cleanup_dataset(site, params):
+    # Delete datasets that are marked as REMOVED and are not referenced by experiment
+    chunksize = params.get('chunk_size') or 100
+    references = build_reference_index(site)
+    # collect everything first, the catalog changes while we delete
+    entries = []
+    # remote objects of remote datasets, by dataset path
+    remote = {}
+    # remote datasets without url in the catalog
+    nourl = 0
+    for brain in removed_datasets(site, references):
+        entries.append((brain.getPath(), brain.Title))
+        url = brain_remote_url(brain)
+        if url and swift_path(SWIFTROOT, url):
+            remote[brain.getPath()] = url
+        elif not url and brain.portal_type == REMOTE_DATASET_TYPE:
+            nourl += 1
+    if nourl and params.get('remote'):
+        LOG.warning("%d remote datasets have no remote url in the catalog; "
+                    "their remote objects won't be cleaned up", nourl)
+    failed = []
+    for start in range(0, len(entries), chunksize):
+        failed.extend(delete_chunk(site, entries[start:start + chunksize]))
+        # deleted objects are still in the pickle cache
+        site._p_jar.cacheMinimize()
+        LOG.info("Processed %d of %d datasets",
+                 min(start + chunksize, len(entries)), len(entries))
 
-    handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    root_logger.addHandler(handler)
+    if failed:
+        # some failures may have been caused by others in the same chunk
+        LOG.info("Retrying %d failed deletes", len(failed))
+        retry, failed = failed, []
+        for entry in retry:
+            failed.extend(delete_chunk(site, [entry]))
+    for path, title in failed:
+        LOG.error("Could not delete dataset %s (%s)", path, title)
+    LOG.info("Deleted %d of %d datasets", len(entries) - len(failed), len(entries))
 
-    logging.getLogger('ZODB.Connection').setLevel(logging.WARN)
+    if params.get('remote'):
+        # datasets which failed to delete, or which are kept, still use
+        # their objects
+        candidates = set(remote.values())
+        urls = sorted(candidates - remote_urls_in_use(site))
+        if len(urls) < len(candidates):
+            LOG.info("Keeping %d remote objects still used by other datasets",
+                     len(candidates) - len(urls))
+        cleanup_remote(params, urls)
+    return failed
 
-    app = spoofRequest(app)
-    newSecurityManager(None, system)
+
+def cleanup_remote(params, urls):
+    """Delete or archive remote objects of deleted remote datasets"""
+    if not urls:
+        return []
+    headers = {}
+    if os.environ.get('OS_AUTH_TOKEN'):
+        headers['X-Auth-Token'] = os.environ['OS_AUTH_TOKEN']
+    client = RemoteClient(per_host=params.get('per_host') or 4, headers=headers,
+                          workers=params.get('remote_workers') or 8)
+    try:
+        if params['remote'] == 'archive':
+            LOG.info("Archiving %d remote objects to %s", len(urls),
+                     params['archive_container'])
+            failed = archive_objects(client, SWIFTROOT, urls,
+                                     params['archive_container'])
+        else:
+            LOG.info("Deleting %d remote objects", len(urls))
+            failed = delete_objects(client, urls)
+    finally:
+        client.close()
+    LOG.info("Cleaned up %d of %d remote objects", len(urls) - len(failed), len(urls))
+    return failed
+
+
+def run(app, params):
+    """Clean up datasets; app has to be prepared with utils.prepare_app"""
     # TODO: works only if site id is bccvl
     portal = app.unrestrictedTraverse('bccvl')
     # we didn't traverse, so we have to set the proper site
 
     with site(portal):
-        cleanup_dataset(portal, params)
+        if params.get('dry_run'):
+            report_cleanup(portal, params)
+        else:
+            cleanup_dataset(portal, params)
+
+
+def main(app, params):
+    setup_logging()
+    run(prepare_app(app), params)
 
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description='Cleanup datasets.')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only report datasets that would be deleted')
+    parser.add_argument('--chunk-size', type=int, metavar='N', default=100,
+                        help='delete N datasets per transaction')
+    parser.add_argument('--remote', choices=['delete', 'archive'],
+                        help='also delete or archive the swift objects of deleted remote datasets')
+    parser.add_argument('--archive-container', default='archive',
+                        help='swift container to archive remote objects to')
+    parser.add_argument('--remote-workers', type=int, metavar='N', default=8,
+                        help='number of concurrent remote requests')
+    parser.add_argument('--per-host', type=int, metavar='N', default=4,
+                        help='max number of concurrent requests per host')
     pargs = parser.parse_args(args)
     return vars(pargs)
 
@@ -0,0 +1,52 @@
+""" Item streams stored as newline delimited JSON
+
+Each line holds one item with its keys sorted, so that the streams
+generated by two releases can be compared with diff. Files with a name
+ending in .gz are gzip compressed.
+"""
+import gzip
+import io
+import json
+
+
+def open_stream(path, mode='r'):
+    """Open the item stream at path for binary reading or writing"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return io.open(path, mode + 'b')
+
+
+class ItemWriter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._stream = open_stream(path, 'w')
+
+    def write(self, item):
+        line = json.dumps(item, sort_keys=True, separators=(',', ':'))
+        self._stream.write(line.encode('utf-8') + b'\n')
+        self.count += 1
+
+    def close(self):
+        self._stream.close()
+
+
+def write_items(path, items):
+    """Write items to the stream at path; returns the number written"""
+    writer = ItemWriter(path)
+    try:
+        for item in items:
+            writer.write(item)
+    finally:
+        writer.close()
+    return writer.count
+
+
+def read_items(path):
+    """Generate the items stored in the stream at path"""
+    with open_stream(path) as stream:
+        for line in stream:
+            line = line.strip()
+            if line:
+                yield json.loads(line.decode('utf-8'))
@@ -0,0 +1,34 @@
+""" Journal of committed import items
+
+The journal is a plain text file with one item path per line. Lines are
+only ever appended, after the transaction containing the items has been
+committed, so that an interrupted import can be resumed by skipping all
+paths found in the journal.
+"""
+import io
+import os
+import os.path
+
+
+def read_journal(path):
+    """Return the set of item paths recorded in the journal at path"""
+    if not os.path.exists(path):
+        return set()
+    with io.open(path, encoding='utf-8') as journal:
+        return set(line.rstrip(u'\n') for line in journal if line.strip())
+
+
+def append_journal(path, paths):
+    """Append paths to the journal and flush them to disk"""
+    with io.open(path, 'a', encoding='utf-8') as journal:
+        for itempath in paths:
+            if isinstance(itempath, bytes):
+                itempath = itempath.decode('utf-8')
+            journal.write(itempath + u'\n')
+        journal.flush()
+        os.fsync(journal.fileno())
+
+
+def truncate_journal(path):
+    """Start a new, empty journal at path"""
+    io.open(path, 'w', encoding='utf-8').close()
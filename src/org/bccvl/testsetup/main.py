@@ -1,39 +1,54 @@
 """ call this with:
     ./bin/instance run src/org.bccvl.testestup/src/org/bccvl/testsetup/main.py ....
 
-    make sure ./bin/instance is down while doing this
+    make sure ./bin/instance is down while doing this, or use --online
+    to import as ZEO client into a running site
 """
+import ConfigParser
+import json
+import os.path
+import posixpath
+import random
+import shutil
+import subprocess
 import sys
+import tempfile
 import logging
-from AccessControl.SecurityManagement import newSecurityManager
-from AccessControl.SpecialUsers import system
-from Testing.makerequest import makerequest
+import time
+from App.config import getConfiguration
+from ZODB.POSException import ConflictError
 import transaction
-from AccessControl.SecurityManager import setSecurityPolicy
-from Products.CMFCore.tests.base.security import PermissiveSecurityPolicy, OmnipotentUser
 from collective.transmogrifier.transmogrifier import Transmogrifier
 import argparse
-# TODO: if item/file id already exists, then just updload/update metadata
-try:
-    from zope.component.hooks import site
-except ImportError:
-    # we have an older zope.compenents:
-    import contextlib
-    from zope.component.hooks import getSite, setSite
-
-    @contextlib.contextmanager
-    def site(site):
-        old_site = getSite()
-        setSite(site)
-        try:
-            yield
-        finally:
-            setSite(old_site)
+from org.bccvl.testsetup.itemstream import ItemWriter, read_items
+from org.bccvl.testsetup.journal import truncate_journal
+from org.bccvl.testsetup.profiling import format_report, merge_reports
+from org.bccvl.testsetup.sharing import thaw
+from org.bccvl.testsetup.transmogrify import (
+    DATASET_TYPES, clear_run_cache, ensure_folders, run_cache)
+from org.bccvl.testsetup.utils import prepare_app, setup_logging, site
+from pkg_resources import resource_filename
 
 LOG = logging.getLogger('org.bccvl.testsetup')
 
 
-def import_data(site, params):
+# base delay in seconds before an online import retries a batch
+RETRY_BACKOFF = 0.5
+
+# source sections in pipeline order
+SOURCES = (
+    'devsource', 'a5ksource', 'a1ksource', 'a250source', 'wccsource',
+    'wcfsource', 'gppsource', 'austsubsfertsource', 'nsgsource',
+    'vastsource', 'mrrtfsource', 'mrvbfsource', 'awapsource', 'petsource',
+    'ndlcsource', 'fparsource', 'cruclimsource', 'accuclimsource',
+    'tasclimsource', 'climondsource', 'narclimsource', 'anuclimsource',
+    'geofabricsource', 'nvissource', 'currentglobalmarinesource',
+    'futureglobalmarinesource', 'marspecmarinesource',
+)
+
+
+def get_source_options(params):
+    """Build transmogrifier overrides for the import requested by params"""
     source_options = {}
     if params.get('dev', 'False'):
         source_options = {
@@ -91,7 +106,7 @@ def import_data(site, params):
         for fcsource in ('a5ksource', 'a1ksource', 'a250source', 'awapsource', 'wcfsource'):
             if params.get(fcsource, False):
                 source_options[fcsource] = {'enabled': 'True'}
-                for p in ['emsc', 'gcm', 'year']:
+                for p in ['emsc', 'gcm', 'year', 'resolution']:
                     if params.get(p, None):
                         source_options[fcsource][p] = \
                             params.get(p, '')
@@ -114,63 +129,460 @@ def import_data(site, params):
                     if params.get(p, None):
                         source_options[source][p] = params.get(p, '')
 
+    source_options['fingerprint'] = {
+        'incremental': str(params.get('incremental'))
+    }
+
     source_options['updatemetadata'] = {
         'siteurl': params.get('siteurl', ''),
-        'sync': str(params.get('sync'))
+        'sync': str(params.get('sync')),
+        'parallel': str(params.get('parallel') or 1),
     }
 
+    commit_options = {}
     if params.get('sync'):
         # in case we do in process metadata update we can commit
-        # after every item
-        source_options['commit'] ={
-            'every': '1'
+        # after every item, or after each set of parallel updates
+        commit_options['every'] = str(params.get('parallel') or 1)
+    if params.get('commit_every') is not None:
+        commit_options['every'] = str(params['commit_every'])
+    if params.get('commit_mb') is not None:
+        commit_options['megabytes'] = str(params['commit_mb'])
+    if commit_options:
+        source_options['commit'] = commit_options
+    return source_options
+
+
+def pipeline_config():
+    """Return pipeline and blueprint of each section from testdataimport.cfg"""
+    parser = ConfigParser.RawConfigParser()
+    parser.optionxform = str
+    parser.read(resource_filename('org.bccvl.testsetup', 'testdataimport.cfg'))
+    pipeline = [name.strip() for name in
+                parser.get('transmogrifier', 'pipeline').splitlines()
+                if name.strip()]
+    blueprints = dict((name, parser.get(name, 'blueprint')) for name in pipeline)
+    return pipeline, blueprints
+
+
+def import_pipeline(options):
+    """Return the pipeline run by an import with transmogrifier options"""
+    if 'transmogrifier' in options:
+        return options['transmogrifier']['pipeline'].split()
+    return pipeline_config()[0]
+
+
+def var_path(name):
+    """Return location of file name in the instance var directory"""
+    clienthome = getattr(getConfiguration(), 'clienthome', None)
+    if not clienthome:
+        # not running within a configured instance
+        return None
+    return os.path.join(clienthome, name)
+
+
+def import_options(params):
+    """Build transmogrifier overrides for an actual import"""
+    source_options = get_source_options(params)
+    # record committed items, so that a failed import can be resumed
+    journal = var_path('testsetup.journal')
+    if journal:
+        if params.get('resume'):
+            source_options['resume'] = {'enabled': 'True', 'journal': journal}
+        else:
+            truncate_journal(journal)
+        source_options.setdefault('commit', {})['journal'] = journal
+
+    if params.get('replay'):
+        # items of an earlier --export replace the sources
+        pipeline = pipeline_config()[0]
+        source_options['transmogrifier'] = {'pipeline': '\n'.join(
+            ['replaysource'] + [name for name in pipeline if name not in SOURCES])}
+        source_options['replaysource'] = {'file': params['replay']}
+
+    if params.get('shard'):
+        # worker of a parallel import
+        index, count = params['shard'].split('/')
+        source_options['shard'] = {
+            'shards': count, 'shard': index, 'containers': 'drop'}
+
+    if params.get('verify_remote'):
+        source_options['verifyremote'] = {
+            'enabled': 'True',
+            'missing': params['verify_remote'],
+            'cache': var_path('testsetup.remote.json') or '',
         }
 
+    if params.get('probe_zip'):
+        source_options['zipprobe'] = {'enabled': 'True'}
+
+    if params.get('profile'):
+        # wrap every section of the pipeline
+        pipeline, blueprints = pipeline_config()
+        for name in pipeline:
+            source_options.setdefault(name, {}).update({
+                'blueprint': 'org.bccvl.testsetup.transmogrify.profile',
+                'profile-blueprint': blueprints[name],
+            })
+    return source_options
+
+
+def write_profile(profiler, params, total):
+    report = profiler.report(total)
+    for line in format_report(report):
+        LOG.info(line)
+    with open(params['profile'], 'w') as reportfile:
+        json.dump(report, reportfile, indent=2)
+    LOG.info('Profile report written to %s', params['profile'])
+
+
+def import_data(site, params):
+    source_options = import_options(params)
     transmogrifier = Transmogrifier(site)
-    transmogrifier(u'org.bccvl.testsetup.dataimport',
-                   **source_options)
+    start = time.time()
+    try:
+        transmogrifier(u'org.bccvl.testsetup.dataimport',
+                       **source_options)
+        profiler = run_cache(site, 'profile').get('profiler')
+    finally:
+        # drop vocabularies and other things cached during the run
+        clear_run_cache(site)
+    commit_start = time.time()
+    transaction.commit()
+
+    if profiler is not None:
+        profiler.get_stats('final commit').add(time.time() - commit_start, False)
+        write_profile(profiler, params, time.time() - start)
+
+
+def generate_items(site, options):
+    """Return all items generated by the sections before constructor
+
+    Items are frozen, see the buffer section. Nothing is written; the
+    transaction is aborted afterwards.
+    """
+    pipeline = import_pipeline(options)
+    split = pipeline.index('constructor')
+    options = dict(options)
+    options['transmogrifier'] = {
+        'pipeline': '\n'.join(pipeline[:split] + ['buffer'])}
+    Transmogrifier(site)(u'org.bccvl.testsetup.dataimport', **options)
+    # start off with fresh data for what follows
+    transaction.abort()
+    buffer = run_cache(site, 'buffer')
+    items = buffer.pop('items', [])
+    # all items are frozen, they keep sharing values without the table
+    buffer.pop('shared', None)
+    LOG.info('Generated %d items', len(items))
+    return items
+
+
+def precreate_folders(site, items):
+    """Create the containers of all items in one go and commit them"""
+    ensure_folders(site, [posixpath.dirname(item['_path'])
+                          for item in items if item.get('_path')])
     transaction.commit()
 
 
-def spoofRequest(app):
+def import_online(site, params):
+    """Import into a live site in small, retried transactions
+
+    All items are generated up front by the sections before constructor
+    and kept in the run cache, and the folders they go into are created.
+    The remaining sections then process them in batches of ``batch_size``
+    items, each batch committed on its own.
+    A batch failing with a ConflictError, because it collided with a
+    concurrent change, is aborted and retried after a random delay that
+    grows with each attempt.
     """
-    Make REQUEST variable to be available on the Zope application server.
+    source_options = import_options(params)
+    pipeline = import_pipeline(source_options)
+    split = pipeline.index('constructor')
+    batchsize = params.get('batch_size') or 10
+    retries = params.get('retries') or 5
+
+    start = time.time()
+    try:
+        items = generate_items(site, source_options)
+        # parents are served from the run cache from now on
+        precreate_folders(site, items)
+        folders = set(run_cache(site, 'objects'))
+        buffer = run_cache(site, 'buffer')
+
+        options = dict(source_options)
+        options['transmogrifier'] = {
+            'pipeline': '\n'.join(['batchsource'] + pipeline[split:])}
+        # batches are committed here; the commit section only journals
+        options['commit'] = dict(options.get('commit', {}),
+                                 every='0', megabytes='0')
+        # folders have been created for all items above
+        options['constructor'] = dict(options.get('constructor', {}),
+                                      **{'create-containers': 'true'})
+        for batchstart in range(0, len(items), batchsize):
+            batch = items[batchstart:batchstart + batchsize]
+            attempt = 0
+            while True:
+                # sections modify items, retry with the original ones
+                buffer['batch'] = [thaw(item) for item in batch]
+                try:
+                    Transmogrifier(site)(u'org.bccvl.testsetup.dataimport',
+                                         **options)
+                    transaction.commit()
+                    break
+                except ConflictError:
+                    transaction.abort()
+                    # objects looked up within the aborted transaction;
+                    # folders have been committed before and stay valid
+                    objects = run_cache(site, 'objects')
+                    for path in list(objects):
+                        if path not in folders:
+                            del objects[path]
+                    if attempt >= retries:
+                        raise
+                    delay = random.uniform(0, RETRY_BACKOFF * 2 ** attempt)
+                    LOG.warning('Conflict importing items %d to %d, '
+                                'retrying in %.1fs', batchstart,
+                                batchstart + len(batch), delay)
+                    time.sleep(delay)
+                    attempt += 1
+            LOG.info('Imported %d of %d items',
+                     batchstart + len(batch), len(items))
+        profiler = run_cache(site, 'profile').get('profiler')
+    finally:
+        clear_run_cache(site)
+
+    if profiler is not None:
+        write_profile(profiler, params, time.time() - start)
+
 
-    This allows acquisition to work properly
+def export_items(site, params):
+    """Write the items generated by the enabled sources to params['export']
+
+    The file can be imported with --replay. Nothing is written to the
+    site, the transaction is aborted in the end.
     """
-    _policy = PermissiveSecurityPolicy()
-    _oldpolicy = setSecurityPolicy(_policy)
-    newSecurityManager(None, OmnipotentUser().__of__(app.acl_users))
-    return makerequest(app)
+    source_options = get_source_options(params)
+    pipeline = pipeline_config()[0]
+    source_options['transmogrifier'] = {'pipeline': '\n'.join(
+        [name for name in pipeline if name in SOURCES] + ['exportitems'])}
+    source_options['exportitems'] = {'file': params['export']}
+    try:
+        Transmogrifier(site)(u'org.bccvl.testsetup.dataimport', **source_options)
+    finally:
+        clear_run_cache(site)
+        transaction.abort()
 
 
-def main(app, params):
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
+def strip_options(args, names):
+    """Return command line args without options names and their values"""
+    result = []
+    skip = False
+    for arg in args:
+        if skip:
+            skip = False
+        elif arg in names:
+            skip = True
+        elif arg.split('=', 1)[0] not in names:
+            result.append(arg)
+    return result
+
+
+def import_parallel(site, params):
+    """Import with params['workers'] worker processes
+
+    The enabled sources run only once, here; their items are written to
+    an item stream which all workers replay (or the stream given with
+    --replay is used). Folders and container items are created here
+    first, in a single pass over the stream, so that workers don't race
+    each other creating them. Dataset items are then split by a hash of
+    their path across the workers. Each worker is an online import in its
+    own params['instance'] process, i.e. a ZEO client running its own
+    pipeline. Their profile reports are merged into one.
+    """
+    workers = params['workers']
+    instance = params['instance']
+    if not os.path.isfile(instance):
+        raise ValueError('Instance script {0} does not exist'.format(instance))
+    journal = var_path('testsetup.journal')
+    if journal and not params.get('resume'):
+        truncate_journal(journal)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        stream = params.get('replay')
+        if not stream:
+            stream = os.path.join(tmpdir, 'items.ndjson')
+            export_items(site, dict(params, export=stream))
 
-    handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    root_logger.addHandler(handler)
+        # collect folders and write container items in one go
+        folders = set()
+        containers = ItemWriter(os.path.join(tmpdir, 'containers.ndjson'))
+        try:
+            for item in read_items(stream):
+                if item.get('_path'):
+                    folders.add(posixpath.dirname(item['_path']))
+                if item.get('_type') not in DATASET_TYPES:
+                    containers.write(item)
+        finally:
+            containers.close()
+        LOG.info('Creating folders')
+        try:
+            ensure_folders(site, folders)
+            transaction.commit()
+        finally:
+            clear_run_cache(site)
+        if containers.count:
+            LOG.info('Importing %d containers', containers.count)
+            # the journal has been started above
+            import_data(site, dict(params, replay=containers.path, resume=True,
+                                   profile=None))
 
-    logging.getLogger('ZODB.Connection').setLevel(logging.WARN)
-    # logging.getLogger('').setLevel(logging.WARN)
-    # logging.getLogger('').setLevel(logging.WARN)
+        args = strip_options(params['argv'], (
+            '--workers', '--shard', '--profile', '--instance', '--replay'))
+        procs = []
+        for index in range(workers):
+            report = os.path.join(tmpdir, 'shard-{0}.json'.format(index))
+            # --resume picks up the journal of the container import
+            cmd = [instance, 'testsetup'] + args + [
+                '--online', '--resume', '--replay', stream,
+                '--shard', '{0}/{1}'.format(index, workers), '--profile', report]
+            LOG.info('Starting worker %d: %s', index, ' '.join(cmd))
+            procs.append((index, report, subprocess.Popen(cmd)))
 
-    app = spoofRequest(app)
-    newSecurityManager(None, system)
+        failed = []
+        reports = []
+        for index, report, proc in procs:
+            if proc.wait() != 0:
+                LOG.error('Worker %d failed with exit code %d', index, proc.returncode)
+                failed.append(index)
+            if os.path.exists(report):
+                with open(report) as reportfile:
+                    reports.append(json.load(reportfile))
+        report = merge_reports(reports)
+        for line in format_report(report):
+            LOG.info(line)
+        if params.get('profile'):
+            with open(params['profile'], 'w') as reportfile:
+                json.dump(report, reportfile, indent=2)
+    finally:
+        shutil.rmtree(tmpdir)
+    if failed:
+        raise RuntimeError('Import workers {0} failed'.format(
+            ', '.join(str(index) for index in failed)))
+
+
+def plan_import(site, params):
+    """Report what an import with the given params would do
+
+    Each enabled source is run on its own into the importplan section,
+    which compares the generated items against the catalog, and estimates
+    the bytes of Swift objects to transfer from the remote object cache
+    (and HEAD requests with --verify-remote). Nothing is written, the
+    transaction is aborted in the end.
+    """
+    source_options = get_source_options(params)
+    sources = [name for name in SOURCES
+               if source_options.get(name, {}).get('enabled') == 'True']
+    try:
+        for name in sources:
+            options = dict(source_options)
+            options['transmogrifier'] = {'pipeline': '{}\nimportplan'.format(name)}
+            options['importplan'] = {
+                'source': name,
+                'incremental': str(params.get('incremental')),
+                'cache': var_path('testsetup.remote.json') or '',
+                'head': str(bool(params.get('verify_remote'))),
+            }
+            transmogrifier = Transmogrifier(site)
+            transmogrifier(u'org.bccvl.testsetup.dataimport', **options)
+        plan = dict(run_cache(site, 'importplan'))
+    finally:
+        clear_run_cache(site)
+        transaction.abort()
+
+    columns = ('create', 'update', 'skip', 'bytes', 'unknown')
+    LOG.info('%-28s %8s %8s %8s %14s %8s', 'source', *columns)
+    total = dict((key, 0) for key in columns)
+    for name in sources:
+        counts = plan.get(name, {})
+        LOG.info('%-28s %8d %8d %8d %14d %8d', name,
+                 counts.get('create', 0), counts.get('update', 0),
+                 counts.get('skip', 0), counts.get('bytes', 0),
+                 counts.get('unknown', 0))
+        for key in total:
+            total[key] += counts.get(key, 0)
+    LOG.info('%-28s %8d %8d %8d %14d %8d', 'total',
+             total['create'], total['update'], total['skip'],
+             total['bytes'], total['unknown'])
+    if total['unknown']:
+        LOG.info('%d remote objects of unknown size are not included in the '
+                 'byte estimate', total['unknown'])
+    return plan
+
+
+def run(app, params):
+    """Import datasets; app has to be prepared with utils.prepare_app"""
     # TODO: works only if site id is bccvl
     portal = app.unrestrictedTraverse('bccvl')
     # we didn't traverse, so we have to set the proper site
 
     with site(portal):
-        import_data(portal, params)
+        if params.get('plan'):
+            plan_import(portal, params)
+        elif params.get('export'):
+            export_items(portal, params)
+        elif (params.get('workers') or 0) > 1:
+            import_parallel(portal, params)
+        elif params.get('online'):
+            import_online(portal, params)
+        else:
+            import_data(portal, params)
+
+
+def main(app, params):
+    setup_logging()
+    run(prepare_app(app), params)
 
 
 def parse_args(args):
     parser = argparse.ArgumentParser(description='Import datasets.')
     parser.add_argument('--siteurl')
     parser.add_argument('--sync', action='store_true')
+    parser.add_argument('--plan', action='store_true',
+                        help='only report how many datasets would be created, updated or skipped')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help='time each pipeline section and write a json report to REPORT')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip items committed by the previous, interrupted import')
+    parser.add_argument('--verify-remote', nargs='?', const='drop',
+                        choices=['drop', 'flag'],
+                        help='check remote objects exist, and drop (default) or flag items without')
+    parser.add_argument('--probe-zip', action='store_true',
+                        help='list layers of remote zips before their metadata update')
+    parser.add_argument('--export', metavar='FILE',
+                        help='only write the items generated by the sources to FILE (.gz to compress)')
+    parser.add_argument('--replay', metavar='FILE',
+                        help='import the items stored in FILE by --export instead of running the sources')
+    parser.add_argument('--online', action='store_true',
+                        help='import into a running site in small transactions, retrying on conflicts')
+    parser.add_argument('--batch-size', type=int, metavar='N',
+                        help='with --online, commit every N items (default 10)')
+    parser.add_argument('--retries', type=int, metavar='N',
+                        help='with --online, retry a conflicting batch N times (default 5)')
+    parser.add_argument('--workers', type=int, metavar='N',
+                        help='import datasets with N --online worker processes')
+    parser.add_argument('--shard', metavar='I/N',
+                        help='only import datasets of shard I out of N (set by --workers)')
+    parser.add_argument('--instance', metavar='PATH',
+                        help='instance script used to start workers, e.g. ./bin/instance')
+    parser.add_argument('--incremental', action='store_true',
+                        help='skip datasets which are unchanged since the last import')
+    parser.add_argument('--commit-every', type=int, metavar='N',
+                        help='commit after every N items')
+    parser.add_argument('--commit-mb', type=float, metavar='M',
+                        help='commit whenever pending changes exceed M megabytes')
+    parser.add_argument('--parallel', type=int, metavar='N',
+                        help='run up to N metadata updates concurrently')
     parser.add_argument('--dev', action='store_true')
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--all', action='store_true')
@@ -180,6 +592,7 @@ def parse_args(args):
     parser.add_argument('--gcm')
     parser.add_argument('--emsc')
     parser.add_argument('--year')
+    parser.add_argument('--resolution')
     parser.add_argument('--austsubsfertsource', action='store_true')
     parser.add_argument('--nsgsource', action='store_true')
     parser.add_argument('--vastsource', action='store_true')
@@ -207,7 +620,13 @@ def parse_args(args):
     parser.add_argument('--btype', type=str, choices=['catchment', 'stream'], help='Geofabric boundary type')
     parser.add_argument('--dstype', type=str, help='Geofabric dataset type i.e. climate, vegetation')
     pargs = parser.parse_args(args)
-    return vars(pargs)
+    if (pargs.workers or 0) > 1 and not pargs.instance:
+        # zopectl commands can't tell which script started them
+        parser.error('--workers needs --instance')
+    params = vars(pargs)
+    # passed on to workers of a parallel import
+    params['argv'] = list(args)
+    return params
 
 
 def zopectl(app, args):
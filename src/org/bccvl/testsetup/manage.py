@@ -2,28 +2,13 @@ import argparse
 import logging
 import sys
 
-from AccessControl.SecurityManagement import newSecurityManager
-from AccessControl.SecurityManager import setSecurityPolicy
-from AccessControl.SpecialUsers import system
-from Products.CMFCore.tests.base.security import PermissiveSecurityPolicy, OmnipotentUser
-from Testing.makerequest import makerequest
 import transaction
 from zope.component.hooks import setSite
 
+from org.bccvl.testsetup.utils import prepare_app, setup_logging
 
-LOG = logging.getLogger(__name__)
-
-
-def spoofRequest(app):
-    """
-    Make REQUEST variable to be available on the Zope application server.
 
-    This allows acquisition to work properly
-    """
-    _policy = PermissiveSecurityPolicy()
-    _oldpolicy = setSecurityPolicy(_policy)
-    newSecurityManager(None, OmnipotentUser().__of__(app.acl_users))
-    return makerequest(app)
+LOG = logging.getLogger(__name__)
 
 
 def create_site(app, params):
@@ -69,21 +54,8 @@ def parse_args(args):
     return vars(pargs)
 
 
-def main(app, params):
-    root_logger = logging.getLogger()
-    root_logger.setLevel(logging.INFO)
-
-    handler = logging.StreamHandler(sys.stdout)
-    formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-    handler.setFormatter(formatter)
-    root_logger.addHandler(handler)
-
-    logging.getLogger('ZODB.Connection').setLevel(logging.WARN)
-    # logging.getLogger('').setLevel(logging.WARN)
-    # logging.getLogger('').setLevel(logging.WARN)
-
-    app = spoofRequest(app)
-    newSecurityManager(None, system)
+def run(app, params):
+    """Create / upgrade site; app has to be prepared with utils.prepare_app"""
     site, created = create_site(app, params)
 
     # setup component architecture
@@ -140,6 +112,11 @@ def main(app, params):
         transaction.commit()
 
 
+def main(app, params):
+    setup_logging()
+    run(prepare_app(app), params)
+
+
 def zopectl(app, args):
     """ zopectl entry point
     app ... the Zope root Application
@@ -0,0 +1,140 @@
+""" Timing of transmogrifier pipeline sections
+
+Each section of a pipeline is wrapped with Profiler.wrap. Time spent
+while pulling an item from a wrapped section, minus the time spent in
+wrapped sections further up the pipeline, is accounted to that section.
+"""
+import time
+
+
+class SectionStats(object):
+
+    def __init__(self, name):
+        self.name = name
+        # number of items passed on
+        self.count = 0
+        # total time spent in section
+        self.time = 0.0
+        # time spent to produce each item
+        self.latencies = []
+
+    def add(self, elapsed, item=True):
+        self.time += elapsed
+        if item:
+            self.count += 1
+            self.latencies.append(elapsed)
+
+    def percentile(self, percent):
+        if not self.latencies:
+            return 0.0
+        values = sorted(self.latencies)
+        return values[int(round(percent / 100.0 * (len(values) - 1)))]
+
+    def as_dict(self):
+        return {
+            'section': self.name,
+            'items': self.count,
+            'time': self.time,
+            'items_per_sec': self.count / self.time if self.time else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+        }
+
+
+class Profiler(object):
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.stats = {}
+        # order in which sections have been wrapped
+        self.sections = []
+        # time spent in upstream sections, one entry per active pull
+        self._stack = []
+
+    def get_stats(self, name):
+        if name not in self.stats:
+            self.stats[name] = SectionStats(name)
+            self.sections.append(name)
+        return self.stats[name]
+
+    def wrap(self, name, section):
+        """Return an iterator over section which records its timings"""
+        return self._iterate(self.get_stats(name), section)
+
+    def _iterate(self, stats, section):
+        iterator = None
+        while True:
+            self._stack.append(0.0)
+            start = self.clock()
+            try:
+                if iterator is None:
+                    iterator = iter(section)
+                item = next(iterator)
+            except StopIteration:
+                self._record(stats, start, False)
+                return
+            except Exception:
+                self._record(stats, start, False)
+                raise
+            self._record(stats, start, True)
+            yield item
+
+    def _record(self, stats, start, item):
+        elapsed = self.clock() - start
+        upstream = self._stack.pop()
+        if self._stack:
+            # the section pulling from us must not be charged for our time
+            self._stack[-1] += elapsed
+        stats.add(elapsed - upstream, item)
+
+    def report(self, total=None):
+        return {
+            'total': total,
+            'sections': [self.stats[name].as_dict() for name in self.sections],
+        }
+
+
+def merge_reports(reports):
+    """Merge reports of runs done in parallel into one
+
+    Items and time are summed up per section. Percentiles can't be merged,
+    the largest of all reports is used instead. The total is the one of
+    the longest run.
+    """
+    sections = {}
+    order = []
+    for report in reports:
+        for stats in report['sections']:
+            name = stats['section']
+            if name not in sections:
+                order.append(name)
+                sections[name] = {'section': name, 'items': 0, 'time': 0.0,
+                                  'p50': 0.0, 'p95': 0.0}
+            merged = sections[name]
+            merged['items'] += stats['items']
+            merged['time'] += stats['time']
+            merged['p50'] = max(merged['p50'], stats['p50'])
+            merged['p95'] = max(merged['p95'], stats['p95'])
+    for merged in sections.values():
+        merged['items_per_sec'] = (merged['items'] / merged['time']
+                                   if merged['time'] else 0.0)
+    totals = [report['total'] for report in reports
+              if report.get('total') is not None]
+    return {
+        'total': max(totals) if totals else None,
+        'sections': [sections[section] for section in order],
+    }
+
+
+def format_report(report):
+    """Return report as lines of a table"""
+    lines = ['{0:<28} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10}'.format(
+        'section', 'items', 'time [s]', 'items/s', 'p50 [ms]', 'p95 [ms]')]
+    for stats in report['sections']:
+        lines.append('{0:<28} {1:>8d} {2:>10.2f} {3:>10.1f} {4:>10.2f} {5:>10.2f}'.format(
+            stats['section'], stats['items'], stats['time'],
+            stats['items_per_sec'], stats['p50'] * 1000, stats['p95'] * 1000))
+    if report.get('total') is not None:
+        lines.append('{0:<28} {1:>8} {2:>10.2f}'.format(
+            'total', '', report['total']))
+    return lines
@@ -0,0 +1,249 @@
+""" Concurrent requests against the Swift object store
+
+RemoteClient keeps one HTTP connection per host and thread, and limits
+the number of concurrent requests per host. Requests failing with a
+connection error or a 5xx status are retried with exponential backoff.
+Its pool of worker threads, and with them their connections, lasts until
+the client is closed.
+"""
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+import json
+import logging
+import os
+import os.path
+import socket
+import threading
+import time
+
+try:
+    import httplib
+    from urlparse import urlsplit
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlsplit
+
+
+LOG = logging.getLogger(__name__)
+
+
+Response = namedtuple('Response', ['status', 'headers', 'body'])
+
+
+class RemoteClient(object):
+
+    def __init__(self, per_host=4, retries=3, backoff=0.5, timeout=60,
+                 headers=None, workers=8):
+        self.per_host = per_host
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # headers sent with every request, e.g. X-Auth-Token
+        self.headers = dict(headers or {})
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._pool = None
+        # all open connections, to close them from any thread
+        self._connections = set()
+
+    def _semaphore(self, netloc):
+        with self._lock:
+            if netloc not in self._semaphores:
+                self._semaphores[netloc] = threading.BoundedSemaphore(self.per_host)
+            return self._semaphores[netloc]
+
+    def _connection(self, scheme, netloc):
+        connections = self._local.__dict__.setdefault('connections', {})
+        key = (scheme, netloc)
+        if key not in connections:
+            if scheme == 'https':
+                connections[key] = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                connections[key] = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            with self._lock:
+                self._connections.add(connections[key])
+        return connections[key]
+
+    def _drop_connection(self, scheme, netloc):
+        connections = self._local.__dict__.get('connections', {})
+        conn = connections.pop((scheme, netloc), None)
+        if conn is not None:
+            with self._lock:
+                self._connections.discard(conn)
+            conn.close()
+
+    def request(self, method, url, headers=None):
+        """Send a request and return a Response
+
+        Raises the last error if the request still fails after all
+        retries. A 5xx Response is returned if retries are exhausted.
+        """
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{0}?{1}'.format(path, parts.query)
+        reqheaders = dict(self.headers)
+        reqheaders.update(headers or {})
+
+        attempt = 0
+        while True:
+            try:
+                with self._semaphore(parts.netloc):
+                    conn = self._connection(parts.scheme, parts.netloc)
+                    conn.request(method, path, headers=reqheaders)
+                    resp = conn.getresponse()
+                    # always read the body, so that the connection can be reused
+                    body = resp.read()
+                response = Response(
+                    resp.status,
+                    dict((name.lower(), value) for name, value in resp.getheaders()),
+                    body)
+                if response.status < 500 or attempt >= self.retries:
+                    return response
+                LOG.warning('%s %s failed with status %s, retrying',
+                            method, url, response.status)
+            except (socket.error, httplib.HTTPException) as e:
+                self._drop_connection(parts.scheme, parts.netloc)
+                if attempt >= self.retries:
+                    raise
+                LOG.warning('%s %s failed with %s, retrying', method, url, e)
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
+
+    def map(self, func, items):
+        """Call func on each of items on the client's worker threads
+
+        Returns a list of (item, result, error) tuples in order of items.
+        """
+        def call(item):
+            try:
+                return (item, func(item), None)
+            except Exception as e:
+                return (item, None, e)
+
+        items = list(items)
+        if not items:
+            return []
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+        return self._pool.map(call, items)
+
+    def close(self):
+        """Stop the worker threads and close all connections"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+            connections, self._connections = self._connections, set()
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for conn in connections:
+            conn.close()
+
+
+def swift_path(root, url):
+    """Return container/object part of url, or None if url is not under root"""
+    prefix = root.rstrip('/') + '/'
+    if not url.startswith(prefix):
+        return None
+    return url[len(prefix):]
+
+
+def delete_objects(client, urls):
+    """Delete objects at urls; returns list of urls which failed
+
+    Objects which don't exist (anymore) count as deleted.
+    """
+    failed = []
+    for url, response, error in client.map(
+            lambda url: client.request('DELETE', url), urls):
+        if error is None and (response.status < 300 or response.status == 404):
+            continue
+        LOG.error('Failed to delete %s: %s', url,
+                  error if error is not None else response.status)
+        failed.append(url)
+    return failed
+
+
+def archive_objects(client, root, urls, container):
+    """Move objects at urls under root into the archive container
+
+    Each object is copied server side to container/<original path>, and
+    deleted once the copy succeeded. Returns list of urls which failed.
+    """
+    def archive(url):
+        path = swift_path(root, url)
+        response = client.request(
+            'COPY', url, {'Destination': '{0}/{1}'.format(container, path)})
+        if response.status >= 300:
+            return response
+        return client.request('DELETE', url)
+
+    failed = []
+    for url, response, error in client.map(archive, urls):
+        if error is None and response.status < 300:
+            continue
+        LOG.error('Failed to archive %s: %s', url,
+                  error if error is not None else response.status)
+        failed.append(url)
+    return failed
+
+
+def load_cache(path):
+    """Return object info cache stored at path, see head_objects"""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as cachefile:
+        try:
+            return json.load(cachefile)
+        except ValueError:
+            LOG.warning('Ignoring broken remote object cache %s', path)
+            return {}
+
+
+def save_cache(path, cache):
+    # parallel imports may save the cache at the same time
+    tmppath = '{0}.{1}.tmp'.format(path, os.getpid())
+    with open(tmppath, 'w') as cachefile:
+        json.dump(cache, cachefile)
+    os.rename(tmppath, path)
+
+
+def head_objects(client, urls, cache):
+    """Check that objects at urls exist
+
+    Returns a dict mapping each url to a dict with etag, size and
+    last_modified of the object, or to None if the object does not exist.
+    Urls that could not be checked are left out.
+
+    cache maps urls to the info returned by earlier runs and is updated in
+    place. Cached objects are requested conditionally on their etag, so
+    unchanged objects are confirmed without sending their headers again.
+    """
+    def head(url):
+        headers = {}
+        if url in cache and cache[url].get('etag'):
+            headers['If-None-Match'] = cache[url]['etag']
+        return client.request('HEAD', url, headers)
+
+    result = {}
+    for url, response, error in client.map(head, urls):
+        if error is not None:
+            LOG.error('Failed to check %s: %s', url, error)
+        elif response.status == 304:
+            result[url] = cache[url]
+        elif response.status == 404:
+            cache.pop(url, None)
+            result[url] = None
+        elif response.status < 300:
+            size = response.headers.get('content-length')
+            cache[url] = result[url] = {
+                'etag': response.headers.get('etag'),
+                'size': int(size) if size is not None else None,
+                'last_modified': response.headers.get('last-modified'),
+            }
+        else:
+            LOG.error('Failed to check %s: %s', url, response.status)
+    return result
@@ -0,0 +1,108 @@
+""" Compact storage of buffered import items
+
+Generated items repeat the same strings (tags, owners, descriptions) and
+sub-structures (subject lists, bccvlmetadata dicts) over and over.
+freeze returns a copy of an item in which equal strings and equal
+sub-structures are one and the same object, shared with all other items
+frozen with the same table. Frozen lists become FrozenList tuples and
+frozen dicts FrozenDicts, so that shared structures can't be changed by
+accident.
+
+Frozen items are meant to be held, not processed: thaw returns a private,
+mutable copy of a frozen item to pass on to sections which modify items.
+Only items collected by the buffer section (--online, and the --workers
+processes) are frozen; sources don't share values between the items they
+generate, as later sections modify items in place.
+"""
+import sys
+
+
+class FrozenList(tuple):
+    """A list stored by freeze"""
+
+    __slots__ = ()
+
+
+def _immutable(self, *args, **kw):
+    raise TypeError('{0} is shared and can not be changed'.format(
+        type(self).__name__))
+
+
+class FrozenDict(dict):
+    """A dict stored by freeze; all methods changing it raise TypeError"""
+
+    __slots__ = ()
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (type(self), (dict(self), ))
+
+
+def _freeze(value, table):
+    """Return frozen value and a hashable key identifying it in table"""
+    if isinstance(value, dict):
+        parts = sorted((_freeze(key, table)[0], _freeze(item, table))
+                       for key, item in value.items())
+        key = (dict, tuple((name, part[1]) for name, part in parts))
+        if key not in table:
+            table[key] = FrozenDict((name, part[0]) for name, part in parts)
+    elif isinstance(value, (list, tuple)):
+        parts = [_freeze(item, table) for item in value]
+        key = (type(value), tuple(part[1] for part in parts))
+        if key not in table:
+            frozen = (part[0] for part in parts)
+            if isinstance(value, (list, FrozenList)):
+                table[key] = FrozenList(frozen)
+            else:
+                table[key] = tuple(frozen)
+    else:
+        key = (type(value), value)
+        if isinstance(value, (bytes, type(u''))):
+            table.setdefault(key, value)
+        else:
+            # numbers, None, ... aren't worth sharing
+            return value, key
+    return table[key], key
+
+
+def freeze(item, table):
+    """Return a frozen copy of item sharing its values through table
+
+    table is a dict which has to be passed to all calls sharing values.
+    The item itself is copied, but not shared, as items are unique.
+    """
+    return dict((_freeze(key, table)[0], _freeze(value, table)[0])
+                for key, value in item.items())
+
+
+def thaw(value):
+    """Return a mutable copy of frozen value which shares nothing mutable"""
+    if isinstance(value, dict):
+        return dict((key, thaw(item)) for key, item in value.items())
+    if isinstance(value, FrozenList):
+        return [thaw(item) for item in value]
+    if isinstance(value, tuple):
+        return tuple(thaw(item) for item in value)
+    return value
+
+
+def deep_size(value, seen=None):
+    """Return bytes used by value and everything it contains
+
+    Objects referenced more than once are only counted once.
+    """
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += deep_size(key, seen) + deep_size(item, seen)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            size += deep_size(item, seen)
+    return size
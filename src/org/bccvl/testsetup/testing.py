@@ -0,0 +1,66 @@
+""" Test layers for org.bccvl.testsetup
+
+The layers install the BCCVL site into a throwaway in-memory ZODB. Celery
+tasks run eagerly in process, and the datamover metadata update task is
+replaced by a stand-in which only records the urls it has been called
+with, and the threads it ran on.
+"""
+import threading
+
+from plone.app.testing import FunctionalTesting
+from plone.app.testing import PLONE_FIXTURE
+from plone.app.testing import PloneSandboxLayer
+
+from org.bccvl.tasks.celery import app as celery_app
+
+
+UPDATE_METADATA = 'org.bccvl.tasks.datamover.tasks.update_metadata'
+
+# urls passed to the stand-in update_metadata task
+UPDATED = []
+
+# idents of the threads it ran on
+UPDATE_THREADS = set()
+
+
+def update_metadata(url, filename, contenttype, context):
+    UPDATED.append(url)
+    UPDATE_THREADS.add(threading.current_thread().ident)
+
+
+class TestSetupLayer(PloneSandboxLayer):
+
+    defaultBases = (PLONE_FIXTURE, )
+
+    def setUpZope(self, app, configurationContext):
+        import org.bccvl.site
+        self.loadZCML(package=org.bccvl.site)
+        import org.bccvl.testsetup
+        self.loadZCML(package=org.bccvl.testsetup)
+
+        self._celery_conf = {
+            'CELERY_ALWAYS_EAGER': celery_app.conf.get('CELERY_ALWAYS_EAGER'),
+            'CELERY_EAGER_PROPAGATES_EXCEPTIONS':
+                celery_app.conf.get('CELERY_EAGER_PROPAGATES_EXCEPTIONS'),
+        }
+        celery_app.conf['CELERY_ALWAYS_EAGER'] = True
+        celery_app.conf['CELERY_EAGER_PROPAGATES_EXCEPTIONS'] = True
+        # replace the datamover task with a local stand-in
+        self._update_metadata = celery_app.tasks.pop(UPDATE_METADATA, None)
+        celery_app.task(name=UPDATE_METADATA, shared=False)(update_metadata)
+
+    def tearDownZope(self, app):
+        celery_app.tasks.pop(UPDATE_METADATA, None)
+        if self._update_metadata is not None:
+            celery_app.tasks[UPDATE_METADATA] = self._update_metadata
+        celery_app.conf.update(self._celery_conf)
+
+    def setUpPloneSite(self, portal):
+        self.applyProfile(portal, 'org.bccvl.site:default')
+
+
+BCCVL_TESTSETUP_FIXTURE = TestSetupLayer()
+
+BCCVL_TESTSETUP_FUNCTIONAL_TESTING = FunctionalTesting(
+    bases=(BCCVL_TESTSETUP_FIXTURE, ),
+    name='BCCVLTestSetupFixture:Functional')
@@ -0,0 +1,296 @@
+""" Throughput benchmarks for the import pipeline
+
+Results are compared against the baselines committed in benchmark.json
+next to this module; a benchmark without a baseline fails. Each run is
+measured in a forked child process, which leaves the site untouched.
+Throughput is the median of BENCHMARK_REPEAT runs (default 3) and fails
+if it drops by more than BENCHMARK_TOLERANCE (default 0.5); runs shorter
+than MIN_ELAPSED are too noisy to compare. Peak memory is how much the
+peak RSS of the child grew while it ran; it fails if it grows by more
+than BENCHMARK_MEMORY_TOLERANCE (default 0.25) plus MEMORY_SLACK.
+
+Baselines are never written to the source tree: with BENCHMARK_OUTPUT
+set to a file name, all measurements are written to that file instead
+of being compared, to be reviewed and copied over benchmark.json.
+"""
+import json
+import os
+import os.path
+import pickle
+import resource
+import time
+import traceback
+import unittest
+
+try:
+    from org.bccvl.testsetup.testing import BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+except ImportError:
+    # benchmarks need a full Plone / BCCVL environment
+    BCCVL_TESTSETUP_FUNCTIONAL_TESTING = None
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), 'benchmark.json')
+
+OUTPUT = os.environ.get('BENCHMARK_OUTPUT')
+
+REPEAT = int(os.environ.get('BENCHMARK_REPEAT', '3'))
+
+TOLERANCE = float(os.environ.get('BENCHMARK_TOLERANCE', '0.5'))
+
+MEMORY_TOLERANCE = float(os.environ.get('BENCHMARK_MEMORY_TOLERANCE', '0.25'))
+
+# seconds
+MIN_ELAPSED = 0.1
+
+# kilobytes of peak RSS growth always accepted, RSS grows page by page
+MEMORY_SLACK = 2048
+
+# sources measured in isolation, devsource is a jsonsource from
+# another package
+SOURCES = (
+    'a5ksource', 'a1ksource', 'a250source', 'wccsource', 'wcfsource',
+    'gppsource', 'austsubsfertsource', 'nsgsource', 'vastsource',
+    'mrrtfsource', 'mrvbfsource', 'awapsource', 'petsource', 'ndlcsource',
+    'fparsource', 'cruclimsource', 'accuclimsource', 'tasclimsource',
+    'climondsource', 'narclimsource', 'anuclimsource', 'geofabricsource',
+    'nvissource', 'currentglobalmarinesource', 'futureglobalmarinesource',
+    'marspecmarinesource',
+)
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def peak_rss():
+    """Return peak resident set size of this process in kilobytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(func):
+    """Call func in a forked child process
+
+    Returns the result of func, the seconds it took and how much the peak
+    RSS of the child grew meanwhile, in kilobytes. A forked child starts
+    with the RSS of its parent as its peak, so only what func allocates
+    is counted. Nothing func does reaches the parent; its result has to
+    be picklable.
+    """
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            os.close(read)
+            start_rss = peak_rss()
+            start = time.time()
+            result = func()
+            elapsed = time.time() - start
+            data = pickle.dumps((result, elapsed, peak_rss() - start_rss), 2)
+        except BaseException:
+            status = 1
+            data = pickle.dumps(traceback.format_exc(), 2)
+        with os.fdopen(write, 'wb') as output:
+            output.write(data)
+        # skip all cleanup, it belongs to the parent
+        os._exit(status)
+    os.close(write)
+    with os.fdopen(read, 'rb') as source:
+        data = source.read()
+    status = os.waitpid(pid, 0)[1]
+    result = pickle.loads(data)
+    if status:
+        raise AssertionError('benchmark failed:\n{0}'.format(result))
+    return result
+
+
+def measure_runs(func, repeat=REPEAT):
+    """Measure func repeat times; returns its first result, and median
+    seconds and peak RSS growth"""
+    runs = [measure(func) for run in range(repeat)]
+    return (runs[0][0], median([run[1] for run in runs]),
+            median([run[2] for run in runs]))
+
+
+class StubTransmogrifier(object):
+    """Just enough of a transmogrifier to construct a source section"""
+
+    def __init__(self, context):
+        self.context = context
+
+
+def source_items(portal, source):
+    """Generate the items of source, run on its own"""
+    from collective.transmogrifier.interfaces import ISectionBlueprint
+    from zope.component import getUtility
+    from org.bccvl.testsetup.main import pipeline_config
+    from org.bccvl.testsetup.transmogrify import clear_run_cache
+
+    blueprints = pipeline_config()[1]
+    blueprint = getUtility(ISectionBlueprint, blueprints[source])
+    section = blueprint(StubTransmogrifier(portal), source,
+                        {'blueprint': blueprints[source],
+                         'enabled': 'True'},
+                        iter(()))
+    try:
+        for item in section:
+            yield item
+    finally:
+        clear_run_cache(portal)
+
+
+class BenchmarkMixin(object):
+
+    def load_baseline(self):
+        if not os.path.exists(BASELINE):
+            return {}
+        with open(BASELINE) as baselinefile:
+            return json.load(baselinefile)
+
+    def record(self, name, result):
+        if not OUTPUT:
+            return
+        results = {}
+        if os.path.exists(OUTPUT):
+            with open(OUTPUT) as outputfile:
+                results = json.load(outputfile)
+        results[name] = result
+        with open(OUTPUT, 'w') as outputfile:
+            json.dump(results, outputfile, indent=2, sort_keys=True)
+
+    def check_baseline(self, name, result):
+        """Compare result against baseline for name
+
+        result is a dict with 'items_per_sec', 'elapsed' (seconds) and
+        'peak_kb' (peak RSS growth).
+        """
+        if OUTPUT:
+            self.record(name, result)
+            return
+        baseline = self.load_baseline().get(name)
+        if baseline is None:
+            self.fail('{0}: no baseline in {1}, record one with '
+                      'BENCHMARK_OUTPUT'.format(name, BASELINE))
+        if result['elapsed'] >= MIN_ELAPSED:
+            self.assertGreaterEqual(
+                result['items_per_sec'],
+                baseline['items_per_sec'] * (1 - TOLERANCE),
+                '{0}: {1:.1f} items/sec, baseline {2:.1f}'.format(
+                    name, result['items_per_sec'], baseline['items_per_sec']))
+        self.assertLessEqual(
+            result['peak_kb'],
+            baseline['peak_kb'] * (1 + MEMORY_TOLERANCE) + MEMORY_SLACK,
+            '{0}: peak RSS grew by {1} kB, baseline {2} kB'.format(
+                name, result['peak_kb'], baseline['peak_kb']))
+
+
+@unittest.skipIf(BCCVL_TESTSETUP_FUNCTIONAL_TESTING is None,
+                 'plone.app.testing and org.bccvl.site are required')
+class Test_SourceBenchmark(BenchmarkMixin, unittest.TestCase):
+
+    layer = BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+
+    def test_sources(self):
+        portal = self.layer['portal']
+        for source in SOURCES:
+            count, elapsed, peak = measure_runs(
+                lambda: sum(1 for item in source_items(portal, source)))
+            self.assertTrue(count > 0, '{0} generated no items'.format(source))
+            self.check_baseline(source, {
+                'items': count,
+                'elapsed': elapsed,
+                'items_per_sec': count / max(elapsed, 1e-6),
+                'peak_kb': peak,
+            })
+
+
+@unittest.skipIf(BCCVL_TESTSETUP_FUNCTIONAL_TESTING is None,
+                 'plone.app.testing and org.bccvl.site are required')
+class Test_PipelineBenchmark(BenchmarkMixin, unittest.TestCase):
+
+    layer = BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+
+    def test_dataimport(self):
+        from org.bccvl.testsetup import testing
+        from org.bccvl.testsetup.main import import_data
+
+        portal = self.layer['portal']
+        params = {
+            'dev': False,
+            'test': True,
+            'siteurl': portal.absolute_url(),
+            'sync': True,
+        }
+
+        def run():
+            del testing.UPDATED[:]
+            import_data(portal, params)
+            catalog = portal.portal_catalog
+            count = len(catalog.unrestrictedSearchResults(
+                portal_type=['org.bccvl.content.dataset',
+                             'org.bccvl.content.remotedataset']))
+            return count, len(testing.UPDATED)
+
+        # each run imports into its own copy of the site
+        (count, updated), elapsed, peak = measure_runs(run)
+        self.assertTrue(count > 0)
+        # every imported dataset got its metadata update
+        self.assertEqual(updated, count)
+        self.check_baseline('dataimport', {
+            'items': count,
+            'elapsed': elapsed,
+            'items_per_sec': count / max(elapsed, 1e-6),
+            'peak_kb': peak,
+        })
+
+
+@unittest.skipIf(BCCVL_TESTSETUP_FUNCTIONAL_TESTING is None,
+                 'plone.app.testing and org.bccvl.site are required')
+class Test_BufferBenchmark(BenchmarkMixin, unittest.TestCase):
+
+    layer = BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+
+    def test_buffer(self):
+        from org.bccvl.testsetup.main import generate_items
+        from org.bccvl.testsetup.sharing import deep_size
+        from org.bccvl.testsetup.transmogrify import clear_run_cache
+
+        portal = self.layer['portal']
+        options = dict((source, {'enabled': 'True'}) for source in SOURCES)
+
+        def buffered():
+            items = generate_items(portal, options)
+            clear_run_cache(portal)
+            return len(items), deep_size(items)
+
+        def plain():
+            # the same sources, their items held as generated
+            items = []
+            for source in SOURCES:
+                items.extend(source_items(portal, source))
+            return len(items), deep_size(items)
+
+        (count, size), elapsed, peak = measure_runs(buffered)
+        (plaincount, plainsize), plainelapsed, plainpeak = measure_runs(plain)
+        self.assertEqual(count, plaincount)
+        self.assertTrue(size < plainsize,
+                        'buffered items take {0} bytes, plain ones {1} bytes'.format(
+                            size, plainsize))
+        self.check_baseline('buffer', {
+            'items': count,
+            'elapsed': elapsed,
+            'items_per_sec': count / max(elapsed, 1e-6),
+            'peak_kb': peak,
+            'bytes': size,
+        })
+        self.check_baseline('plain', {
+            'items': plaincount,
+            'elapsed': plainelapsed,
+            'items_per_sec': plaincount / max(plainelapsed, 1e-6),
+            'peak_kb': plainpeak,
+            'bytes': plainsize,
+        })
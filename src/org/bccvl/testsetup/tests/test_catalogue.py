@@ -0,0 +1,44 @@
+import unittest
+
+from org.bccvl.testsetup.catalogue import DatasetIndex, get_index
+
+
+class Test_Catalogue(unittest.TestCase):
+
+    catalogue = {
+        'src': [
+            {'emsc': ['A', 'B'], 'gcm': ['x', 'y'], 'year': ['2050']},
+            {'emsc': ['C'], 'gcm': ['x'], 'year': ['2050', '2070']},
+        ],
+        'other': [
+            {'year': ['2000', '2001']},
+        ],
+    }
+
+    def test_expand_blocks(self):
+        index = DatasetIndex(self.catalogue)
+        rows = index.select('src')
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[0], {'emsc': 'A', 'gcm': 'x', 'year': '2050'})
+        self.assertEqual(rows[-1], {'emsc': 'C', 'gcm': 'x', 'year': '2070'})
+
+    def test_select(self):
+        index = DatasetIndex(self.catalogue)
+        rows = index.select('src', emsc=set(['B', 'C']), year=set(['2050']))
+        self.assertEqual(
+            [(r['emsc'], r['gcm']) for r in rows],
+            [('B', 'x'), ('B', 'y'), ('C', 'x')])
+        self.assertEqual(index.select('src', gcm=set(['z'])), [])
+        # unknown dimensions and empty filters are ignored
+        self.assertEqual(len(index.select('other', gcm=set(['x']), year=set())), 2)
+        self.assertEqual(index.select('missing'), [])
+
+    def test_packaged_catalogue(self):
+        index = get_index()
+        self.assertEqual(len(index.select('a5ksource')), 9 * 18 * 8)
+        rows = index.select('a5ksource', emsc=set(['RCP85']), year=set(['2085']))
+        self.assertEqual(len(rows), 18)
+        rows = index.select('wcfsource', gcm=set(['ACCESS1-0']),
+                            resolution=set(['5m']))
+        self.assertEqual(len(rows), 2 * 2 * 4)
+        self.assertEqual(len(index.select('awapsource')), 111)
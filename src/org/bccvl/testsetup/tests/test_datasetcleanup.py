@@ -0,0 +1,161 @@
+import unittest
+
+try:
+    from org.bccvl.testsetup.testing import BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+except ImportError:
+    # cleanup needs a full Plone / BCCVL environment
+    BCCVL_TESTSETUP_FUNCTIONAL_TESTING = None
+
+
+@unittest.skipIf(BCCVL_TESTSETUP_FUNCTIONAL_TESTING is None,
+                 'plone.app.testing and org.bccvl.site are required')
+class Test_DeleteChunk(unittest.TestCase):
+
+    layer = BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        import transaction
+        from plone import api
+        from plone.app.testing import TEST_USER_ID, setRoles
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.entries = []
+        for name in ('first', 'second'):
+            folder = api.content.create(container=self.portal, type='Folder',
+                                        id=name, title=name)
+            for num in range(3):
+                obj = api.content.create(container=folder, type='Document',
+                                         id='{0}-{1}'.format(name, num),
+                                         title=u'Dataset {0}'.format(num))
+                self.entries.append(('/'.join(obj.getPhysicalPath()), obj.title))
+        transaction.commit()
+        self.handlers = []
+
+    def tearDown(self):
+        from zope.component import getGlobalSiteManager
+        gsm = getGlobalSiteManager()
+        for handler, required in self.handlers:
+            gsm.unregisterHandler(handler, required)
+
+    def fail_delete(self, *ids):
+        """Make deleting the objects with ids fail"""
+        from zope.component import getGlobalSiteManager
+        from zope.interface import Interface
+        from OFS.interfaces import IObjectWillBeRemovedEvent
+
+        def handler(obj, event):
+            if obj.getId() in ids:
+                raise ValueError(obj.getId())
+
+        required = (Interface, IObjectWillBeRemovedEvent)
+        getGlobalSiteManager().registerHandler(handler, required)
+        self.handlers.append((handler, required))
+
+    def remaining(self):
+        return sorted(entry for entry in self.entries
+                      if self.portal.unrestrictedTraverse(entry[0], None) is not None)
+
+    def test_delete_chunk(self):
+        from org.bccvl.testsetup.datasetcleanup import delete_chunk
+
+        self.assertEqual(delete_chunk(self.portal, self.entries), [])
+        self.assertEqual(self.remaining(), [])
+
+    def test_failing_dataset_is_rolled_back_alone(self):
+        import transaction
+        from org.bccvl.testsetup.datasetcleanup import delete_chunk
+
+        self.fail_delete('first-1')
+        failed = delete_chunk(self.portal, self.entries)
+        transaction.abort()
+        # the rest of its folder and the other folder are deleted
+        self.assertEqual(failed, [self.entries[1]])
+        self.assertEqual(self.remaining(), [self.entries[1]])
+
+    def test_failing_commit_is_retried_per_dataset(self):
+        import transaction
+        from org.bccvl.testsetup.datasetcleanup import delete_chunk
+
+        def fail():
+            raise ValueError('commit failed')
+
+        # only the first transaction fails to commit
+        transaction.get().addBeforeCommitHook(fail)
+        failed = delete_chunk(self.portal, self.entries)
+        transaction.abort()
+        self.assertEqual(failed, [])
+        self.assertEqual(self.remaining(), [])
+
+
+@unittest.skipIf(BCCVL_TESTSETUP_FUNCTIONAL_TESTING is None,
+                 'plone.app.testing and org.bccvl.site are required')
+class Test_RemoteUrls(unittest.TestCase):
+
+    layer = BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        from plone.app.testing import TEST_USER_ID, setRoles
+        from org.bccvl.site import defaults
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.datasets = self.portal[defaults.DATASETS_FOLDER_ID]
+
+    def removed(self, id, remoteUrl, state='REMOVED'):
+        """Create a remote dataset marked as REMOVED"""
+        from plone import api
+        from org.bccvl.site.job.interfaces import IJobTracker
+        obj = api.content.create(
+            container=self.datasets, type='org.bccvl.content.remotedataset',
+            id=id, title=id, remoteUrl=remoteUrl, safe_id=False)
+        tracker = IJobTracker(obj)
+        tracker.new_job('test', 'test', function='ingest', type=obj.portal_type)
+        tracker.set_progress(state, 'Dataset {0}'.format(state.lower()))
+        obj.reindexObject()
+        return obj
+
+    def test_brain_remote_url(self):
+        from org.bccvl.testsetup.datasetcleanup import brain_remote_url
+        from org.bccvl.testsetup.transmogrify import SWIFTROOT
+
+        url = '{0}/container/remote.zip'.format(SWIFTROOT)
+        obj = self.removed('remote.zip', url)
+        brains = self.portal.portal_catalog.unrestrictedSearchResults(
+            path={'query': '/'.join(obj.getPhysicalPath()), 'depth': 0})
+        self.assertEqual(len(brains), 1)
+        self.assertEqual(brain_remote_url(brains[0]), url)
+
+    def test_report_counts_datasets_without_url(self):
+        import transaction
+        from org.bccvl.testsetup.datasetcleanup import report_cleanup
+        from org.bccvl.testsetup.transmogrify import SWIFTROOT
+
+        url = '{0}/container/remote.zip'.format(SWIFTROOT)
+        self.removed('remote.zip', url)
+        self.removed('nourl.zip', None)
+        transaction.commit()
+
+        folders = report_cleanup(self.portal, {})
+        self.assertEqual(folders['.']['count'], 2)
+        self.assertEqual(folders['.']['urls'], [url])
+        self.assertEqual(folders['.']['nourl'], 1)
+
+    def test_shared_url_is_kept(self):
+        import transaction
+        from org.bccvl.testsetup.datasetcleanup import (
+            cleanup_dataset, remote_urls_in_use, report_cleanup)
+        from org.bccvl.testsetup.transmogrify import SWIFTROOT
+
+        url = '{0}/container/shared.zip'.format(SWIFTROOT)
+        self.removed('old.zip', url)
+        self.removed('live.zip', url, state='COMPLETED')
+        transaction.commit()
+
+        folders = report_cleanup(self.portal, {})
+        self.assertEqual(folders['.']['urls'], [])
+        self.assertEqual(folders['.']['inuse'], 1)
+
+        # nothing is left to clean up remotely, no request is sent
+        self.assertEqual(cleanup_dataset(self.portal, {'remote': 'delete'}), [])
+        self.assertFalse('old.zip' in self.datasets)
+        self.assertTrue('live.zip' in self.datasets)
+        self.assertEqual(remote_urls_in_use(self.portal), set([url]))
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+import gzip
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from org.bccvl.testsetup.itemstream import read_items, write_items
+
+
+ITEMS = [
+    {
+        '_path': 'datasets/climate/worldclim/2_5m/worldclim_2_5m.zip',
+        '_type': 'org.bccvl.content.remotedataset',
+        'title': u'WorldClim, current climate (1950-2000), 2.5 arcmin (~5 km)',
+        'subject': [u'Current datasets'],
+        'bccvlmetadata': {'genre': 'DataGenreCC', 'resolution': 'Resolution2_5m'},
+    },
+    {
+        '_path': 'datasets/environmental/fpar/fpar.2000.zip',
+        'title': u'FPAR caf\xe9',
+        'remoteUrl': None,
+    },
+]
+
+
+class Test_ItemStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        path = os.path.join(self.tmpdir, 'items.ndjson')
+        self.assertEqual(write_items(path, iter(ITEMS)), 2)
+        self.assertEqual(list(read_items(path)), ITEMS)
+        with open(path, 'rb') as stream:
+            lines = stream.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        # keys are sorted, so that streams can be diffed
+        self.assertTrue(lines[0].startswith(b'{"_path":'))
+        self.assertTrue(lines[0].endswith(b'"title":"WorldClim, current climate '
+                                          b'(1950-2000), 2.5 arcmin (~5 km)"}'))
+
+    def test_gzip(self):
+        path = os.path.join(self.tmpdir, 'items.ndjson.gz')
+        write_items(path, ITEMS)
+        stream = gzip.open(path, 'rb')
+        try:
+            self.assertEqual(len(stream.read().splitlines()), 2)
+        finally:
+            stream.close()
+        self.assertEqual(list(read_items(path)), ITEMS)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from org.bccvl.testsetup.journal import append_journal, read_journal, truncate_journal
+
+
+class Test_Journal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'testsetup.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_append_and_read(self):
+        self.assertEqual(read_journal(self.path), set())
+        append_journal(self.path, ['datasets/a.zip', u'datasets/b\xe9.zip'])
+        append_journal(self.path, [b'datasets/c.zip'])
+        self.assertEqual(read_journal(self.path),
+                         set([u'datasets/a.zip', u'datasets/b\xe9.zip',
+                              u'datasets/c.zip']))
+        truncate_journal(self.path)
+        self.assertEqual(read_journal(self.path), set())
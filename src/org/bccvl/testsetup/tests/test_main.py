@@ -0,0 +1,72 @@
+import unittest
+
+try:
+    from org.bccvl.testsetup.testing import BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+except ImportError:
+    # imports need a full Plone / BCCVL environment
+    BCCVL_TESTSETUP_FUNCTIONAL_TESTING = None
+
+
+@unittest.skipIf(BCCVL_TESTSETUP_FUNCTIONAL_TESTING is None,
+                 'plone.app.testing and org.bccvl.site are required')
+class Test_ImportOnline(unittest.TestCase):
+
+    layer = BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        from org.bccvl.testsetup import main
+        self.portal = self.layer['portal']
+        self.backoff = main.RETRY_BACKOFF
+        main.RETRY_BACKOFF = 0
+        self.handlers = []
+
+    def tearDown(self):
+        from zope.component import getGlobalSiteManager
+        from org.bccvl.testsetup import main
+        main.RETRY_BACKOFF = self.backoff
+        gsm = getGlobalSiteManager()
+        for handler, required in self.handlers:
+            gsm.unregisterHandler(handler, required)
+
+    def test_conflicting_batch_is_retried(self):
+        import transaction
+        from zope.component import getGlobalSiteManager
+        from zope.lifecycleevent.interfaces import IObjectAddedEvent
+        from ZODB.POSException import ConflictError
+        from org.bccvl.site.content.interfaces import IDataset
+        from org.bccvl.testsetup import testing
+        from org.bccvl.testsetup.main import import_online
+
+        conflicts = []
+
+        def conflict():
+            raise ConflictError()
+
+        def added(obj, event):
+            # the batch of the first dataset fails to commit once
+            if not conflicts:
+                conflicts.append(obj.getId())
+                transaction.get().addBeforeCommitHook(conflict)
+
+        required = (IDataset, IObjectAddedEvent)
+        getGlobalSiteManager().registerHandler(added, required)
+        self.handlers.append((added, required))
+
+        del testing.UPDATED[:]
+        import_online(self.portal, {
+            'dev': False,
+            'test': True,
+            'siteurl': self.portal.absolute_url(),
+            'sync': True,
+            'batch_size': 5,
+        })
+
+        self.assertEqual(len(conflicts), 1)
+        brains = self.portal.portal_catalog.unrestrictedSearchResults(
+            portal_type=['org.bccvl.content.dataset',
+                         'org.bccvl.content.remotedataset'])
+        # the retried batch is imported as well
+        self.assertTrue(conflicts[0] in [brain.getId for brain in brains])
+        # metadata updates of the conflicting batch only ran once it
+        # committed
+        self.assertEqual(len(testing.UPDATED), len(brains))
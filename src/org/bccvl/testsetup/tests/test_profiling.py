@@ -0,0 +1,73 @@
+import unittest
+
+from org.bccvl.testsetup.profiling import Profiler, SectionStats, format_report
+from org.bccvl.testsetup.profiling import merge_reports
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class Test_Profiling(unittest.TestCase):
+
+    def test_self_time(self):
+        clock = FakeClock()
+        profiler = Profiler(clock)
+
+        def source():
+            for num in range(4):
+                clock.now += 1.0
+                yield {'num': num}
+
+        def double(previous):
+            for item in previous:
+                clock.now += 0.5
+                yield item
+                yield item
+
+        pipeline = profiler.wrap('source', source())
+        pipeline = profiler.wrap('double', double(pipeline))
+        self.assertEqual(len(list(pipeline)), 8)
+
+        report = profiler.report()
+        source_stats, double_stats = report['sections']
+        self.assertEqual(source_stats['section'], 'source')
+        self.assertEqual(source_stats['items'], 4)
+        self.assertEqual(source_stats['time'], 4.0)
+        self.assertEqual(double_stats['items'], 8)
+        self.assertEqual(double_stats['time'], 2.0)
+        self.assertEqual(double_stats['items_per_sec'], 4.0)
+        self.assertEqual(len(format_report(report)), 3)
+
+    def test_percentile(self):
+        stats = SectionStats('test')
+        for num in range(1, 101):
+            stats.add(num / 100.0)
+        stats.add(5.0, item=False)
+        self.assertEqual(stats.count, 100)
+        self.assertEqual(stats.percentile(50), 0.51)
+        self.assertEqual(stats.percentile(95), 0.95)
+        self.assertEqual(SectionStats('empty').percentile(95), 0.0)
+
+    def test_merge_reports(self):
+        first = {'total': 10.0, 'sections': [
+            {'section': 'source', 'items': 4, 'time': 2.0, 'items_per_sec': 2.0,
+             'p50': 0.5, 'p95': 0.5},
+            {'section': 'commit', 'items': 4, 'time': 1.0, 'items_per_sec': 4.0,
+             'p50': 0.1, 'p95': 0.4},
+        ]}
+        second = {'total': 12.0, 'sections': [
+            {'section': 'source', 'items': 6, 'time': 3.0, 'items_per_sec': 2.0,
+             'p50': 0.2, 'p95': 0.9},
+        ]}
+        merged = merge_reports([first, second])
+        self.assertEqual(merged['total'], 12.0)
+        source, commit = merged['sections']
+        self.assertEqual(source, {'section': 'source', 'items': 10, 'time': 5.0,
+                                  'items_per_sec': 2.0, 'p50': 0.5, 'p95': 0.9})
+        self.assertEqual(commit['items'], 4)
@@ -0,0 +1,190 @@
+import os.path
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from org.bccvl.testsetup.remote import RemoteClient, archive_objects, delete_objects
+from org.bccvl.testsetup.remote import head_objects, load_cache, save_cache
+
+
+class SwiftHandler(BaseHTTPRequestHandler):
+    """Minimal Swift like object store keeping objects in server.objects"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def track(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.command, self.path))
+            server.clients.add(self.client_address)
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+        time.sleep(server.delay)
+        with server.lock:
+            server.active -= 1
+        if self.path in self.server.flaky:
+            self.server.flaky.remove(self.path)
+            self.respond(503)
+            return False
+        return True
+
+    def do_HEAD(self):
+        if not self.track():
+            return
+        etag = self.server.objects.get(self.path)
+        if etag is None:
+            self.respond(404)
+        elif self.headers.get('If-None-Match') == etag:
+            self.respond(304)
+        else:
+            self.send_response(200)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', 'Mon, 02 Jan 2017 10:00:00 GMT')
+            self.send_header('Content-Length', str(len(etag)))
+            self.end_headers()
+
+    def do_DELETE(self):
+        if not self.track():
+            return
+        if self.server.objects.pop(self.path, None) is None:
+            self.respond(404)
+        else:
+            self.respond(204)
+
+    def do_COPY(self):
+        if not self.track():
+            return
+        if self.path not in self.server.objects:
+            self.respond(404)
+            return
+        account = self.path.split('/')[1]
+        destination = '/{0}/{1}'.format(account, self.headers['Destination'])
+        self.server.objects[destination] = self.server.objects[self.path]
+        self.respond(201)
+
+
+class SwiftServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), SwiftHandler)
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.requests = []
+        self.clients = set()
+        self.flaky = set()
+        self.delay = 0
+        self.active = 0
+        self.max_active = 0
+
+
+class Test_Remote(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SwiftServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.root = 'http://127.0.0.1:{0}/AUTH_test'.format(self.server.server_port)
+        for num in range(20):
+            self.server.objects['/AUTH_test/data/{0}.zip'.format(num)] = str(num)
+        self.urls = ['{0}/data/{1}.zip'.format(self.root, num) for num in range(20)]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_delete(self):
+        self.server.flaky.add('/AUTH_test/data/3.zip')
+        client = RemoteClient(per_host=4, backoff=0, workers=4)
+        self.addCleanup(client.close)
+        failed = delete_objects(client, self.urls + [self.root + '/data/missing.zip'])
+        self.assertEqual(failed, [])
+        self.assertEqual(self.server.objects, {})
+        # 21 objects plus one retry
+        self.assertEqual(len(self.server.requests), 22)
+        # connections are reused by each worker thread
+        self.assertTrue(len(self.server.clients) <= 5)
+
+    def test_per_host_limit(self):
+        self.server.delay = 0.02
+        client = RemoteClient(per_host=2, backoff=0, workers=8)
+        self.addCleanup(client.close)
+        self.assertEqual(delete_objects(client, self.urls), [])
+        self.assertEqual(self.server.max_active, 2)
+
+    def test_connections_reused_across_calls(self):
+        client = RemoteClient(backoff=0, workers=2)
+        self.addCleanup(client.close)
+        self.assertEqual(delete_objects(client, self.urls[:10]), [])
+        self.assertEqual(delete_objects(client, self.urls[10:]), [])
+        # the same two worker threads and connections serve both calls
+        self.assertTrue(len(self.server.clients) <= 2)
+        client.close()
+        self.assertEqual(client._connections, set())
+        # a closed client starts new workers when used again
+        self.server.objects['/AUTH_test/data/0.zip'] = '0'
+        self.assertEqual(delete_objects(client, self.urls[:1]), [])
+
+    def test_retries_exhausted(self):
+        self.server.flaky.add('/AUTH_test/data/0.zip')
+        client = RemoteClient(retries=0)
+        self.addCleanup(client.close)
+        self.assertEqual(delete_objects(client, self.urls[:1]), self.urls[:1])
+
+    def test_archive(self):
+        client = RemoteClient(backoff=0)
+        self.addCleanup(client.close)
+        failed = archive_objects(client, self.root, self.urls[:2], 'archive')
+        self.assertEqual(failed, [])
+        self.assertEqual(sorted(self.server.objects)[:2],
+                         ['/AUTH_test/archive/data/0.zip',
+                          '/AUTH_test/archive/data/1.zip'])
+        self.assertEqual(len(self.server.objects), 20)
+
+    def test_head(self):
+        client = RemoteClient(backoff=0)
+        self.addCleanup(client.close)
+        missing = self.root + '/data/missing.zip'
+        cache = {}
+        result = head_objects(client, self.urls[:3] + [missing], cache)
+        self.assertEqual(result[missing], None)
+        self.assertEqual(result[self.urls[0]],
+                         {'etag': '0', 'size': 1,
+                          'last_modified': 'Mon, 02 Jan 2017 10:00:00 GMT'})
+        self.assertEqual(sorted(cache), self.urls[:3])
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'remote.json')
+            save_cache(path, cache)
+            cache = load_cache(path)
+        finally:
+            shutil.rmtree(tmpdir)
+        # unchanged objects are confirmed from cache
+        self.server.objects['/AUTH_test/data/1.zip'] = 'changed'
+        result = head_objects(client, self.urls[:2], cache)
+        self.assertEqual(result[self.urls[0]]['etag'], '0')
+        self.assertEqual(result[self.urls[1]]['etag'], 'changed')
+        self.assertEqual(cache[self.urls[1]]['size'], 7)
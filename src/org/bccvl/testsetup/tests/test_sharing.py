@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+from org.bccvl.testsetup.sharing import deep_size, freeze, thaw
+
+
+def make_item(num):
+    return {
+        '_path': 'datasets/climate/worldclim/2_5m/worldclim_{0}.zip'.format(num),
+        '_owner': (1, 'admin'),
+        '_type': 'org.bccvl.content.remotedataset',
+        'title': u'WorldClim layer {0}'.format(num),
+        'description': u' '.join([u'Bioclimatic variables'] * 20),
+        'subject': [u'Terrestrial datasets', u'Current datasets'],
+        'bccvlmetadata': {
+            'genre': 'DataGenreCC',
+            'resolution': 'Resolution2_5m',
+            'categories': ['climate'],
+        },
+        'downloadable': False,
+    }
+
+
+class Test_Sharing(unittest.TestCase):
+
+    def test_freeze_shares_equal_values(self):
+        table = {}
+        first, second = [freeze(make_item(num), table) for num in range(2)]
+        self.assertEqual(thaw(first), make_item(0))
+        self.assertEqual(thaw(second), make_item(1))
+        for key in ('_owner', 'description', 'subject', 'bccvlmetadata'):
+            self.assertTrue(first[key] is second[key], key)
+        self.assertFalse(first['title'] is second['title'])
+        # lists and dicts can't be changed in place
+        self.assertFalse(hasattr(first['subject'], 'append'))
+        with self.assertRaises(TypeError):
+            first['bccvlmetadata']['genre'] = 'DataGenreFC'
+        with self.assertRaises(TypeError):
+            first['bccvlmetadata'].update(genre='DataGenreFC')
+        self.assertEqual(thaw(second), make_item(1))
+
+    def test_thaw_returns_private_copies(self):
+        table = {}
+        frozen = [freeze(make_item(num), table) for num in range(2)]
+        first, second = [thaw(item) for item in frozen]
+        self.assertTrue(isinstance(first['subject'], list))
+        self.assertTrue(type(first['bccvlmetadata']) is dict)
+        self.assertTrue(isinstance(first['_owner'], tuple))
+        first['subject'] += [u'Summary datasets']
+        first['bccvlmetadata']['categories'].append('topography')
+        self.assertEqual(second['subject'], make_item(1)['subject'])
+        self.assertEqual(thaw(frozen[0]), make_item(0))
+        self.assertEqual(second['bccvlmetadata'], make_item(1)['bccvlmetadata'])
+
+    def test_deep_size(self):
+        items = [make_item(num) for num in range(100)]
+        table = {}
+        frozen = [freeze(item, table) for item in items]
+        self.assertTrue(deep_size(frozen) < deep_size(items) / 2)
+        # the table is dropped once all items are frozen, but even with
+        # it the items take less space
+        self.assertTrue(deep_size(frozen) + deep_size(table) < deep_size(items))
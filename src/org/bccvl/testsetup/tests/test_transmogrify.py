@@ -0,0 +1,338 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+
+try:
+    from org.bccvl.testsetup.testing import BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+except ImportError:
+    # sections need a full Plone / BCCVL environment
+    BCCVL_TESTSETUP_FUNCTIONAL_TESTING = None
+
+
+class StubTransmogrifier(object):
+    """Just enough of a transmogrifier to construct a section"""
+
+    def __init__(self, context):
+        self.context = context
+
+
+def make_item(name):
+    return {
+        '_path': 'datasets/{0}'.format(name),
+        '_type': 'org.bccvl.content.remotedataset',
+        'title': u'Test dataset {0}'.format(name),
+        'remoteUrl': 'http://example.com/{0}'.format(name),
+        'format': 'application/zip',
+        'dataSource': 'ingest',
+    }
+
+
+@unittest.skipIf(BCCVL_TESTSETUP_FUNCTIONAL_TESTING is None,
+                 'plone.app.testing and org.bccvl.site are required')
+class Test_DeferredReindex(unittest.TestCase):
+
+    layer = BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        from plone.app.testing import TEST_USER_ID, setRoles
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.catalog = self.portal.portal_catalog
+
+    def create(self, item):
+        from plone import api
+        container = self.portal.unrestrictedTraverse(item['_path'].rsplit('/', 1)[0])
+        return api.content.create(
+            container=container, type=item['_type'],
+            id=item['_path'].rsplit('/', 1)[1], title=item['title'],
+            remoteUrl=item['remoteUrl'], dataSource=item['dataSource'],
+            safe_id=False)
+
+    def search(self, obj, **query):
+        return self.catalog.unrestrictedSearchResults(
+            path={'query': '/'.join(obj.getPhysicalPath()), 'depth': 0}, **query)
+
+    def test_unchanged_item_with_new_job(self):
+        import transaction
+        from zope.annotation import IAnnotations
+        from org.bccvl.site.job.interfaces import IJobTracker
+        from org.bccvl.testsetup.transmogrify import (
+            KEY_DIGESTS_KEY, DeferredReindex, UpdateMetadata, clear_run_cache,
+            item_key_digests)
+
+        item = make_item('unchanged.zip')
+        obj = self.create(item)
+        IAnnotations(obj)[KEY_DIGESTS_KEY] = item_key_digests(item)
+        tracker = IJobTracker(obj)
+        tracker.new_job('test', 'test', function='ingest', type=obj.portal_type)
+        tracker.set_progress('REMOVED', 'Dataset removed')
+        obj.reindexObject()
+        transaction.commit()
+        self.assertEqual(len(self.search(obj, job_state='REMOVED')), 1)
+
+        transmogrifier = StubTransmogrifier(self.portal)
+        section = UpdateMetadata(transmogrifier, 'updatemetadata', {
+            'siteurl': self.portal.absolute_url(),
+            'sync': 'True',
+        }, iter([dict(item)]))
+        section = DeferredReindex(transmogrifier, 'deferredreindex', {}, section)
+        try:
+            self.assertEqual(len(list(section)), 1)
+        finally:
+            clear_run_cache(self.portal)
+        transaction.commit()
+
+        # nothing but the job changed, and the catalog knows about it
+        self.assertEqual(tracker.state, 'PENDING')
+        self.assertEqual(len(self.search(obj, job_state='REMOVED')), 0)
+        self.assertEqual(len(self.search(obj, job_state='PENDING')), 1)
+
+
+@unittest.skipIf(BCCVL_TESTSETUP_FUNCTIONAL_TESTING is None,
+                 'plone.app.testing and org.bccvl.site are required')
+class Test_ImportPlan(unittest.TestCase):
+
+    layer = BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        self.portal = self.layer['portal']
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_byte_estimate(self):
+        from org.bccvl.testsetup.remote import save_cache
+        from org.bccvl.testsetup.transmogrify import ImportPlan, clear_run_cache, run_cache
+
+        items = [make_item('cached.zip'), make_item('uncached.zip')]
+        cache = os.path.join(self.tmpdir, 'remote.json')
+        save_cache(cache, {items[0]['remoteUrl']: {'etag': 'abc', 'size': 1234}})
+        section = ImportPlan(StubTransmogrifier(self.portal), 'importplan', {
+            'source': 'test',
+            'cache': cache,
+        }, iter(items))
+        try:
+            self.assertEqual(list(section), [])
+            counts = run_cache(self.portal, 'importplan')['test']
+        finally:
+            clear_run_cache(self.portal)
+        self.assertEqual(counts['create'], 2)
+        self.assertEqual(counts['bytes'], 1234)
+        self.assertEqual(counts['unknown'], 1)
+
+
+@unittest.skipIf(BCCVL_TESTSETUP_FUNCTIONAL_TESTING is None,
+                 'plone.app.testing and org.bccvl.site are required')
+class Test_Commit(unittest.TestCase):
+
+    layer = BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        from plone.app.testing import TEST_USER_ID, setRoles
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+        self.tmpdir = tempfile.mkdtemp()
+        self.journal = os.path.join(self.tmpdir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def folders(self, names, fail=None):
+        """Create a folder per name and yield its item
+
+        Raises after creating the folder named fail, or calls fail with
+        the folder if it is callable.
+        """
+        from plone import api
+        for name in names:
+            folder = api.content.create(container=self.portal, type='Folder',
+                                        id=name, title=name)
+            if fail == name:
+                raise ValueError(name)
+            if callable(fail):
+                fail(folder)
+            yield {'_path': name}
+
+    def commit(self, previous, every):
+        from org.bccvl.testsetup.transmogrify import Commit
+        return Commit(StubTransmogrifier(self.portal), 'commit', {
+            'every': str(every),
+            'journal': self.journal,
+        }, previous)
+
+    def test_failing_item_rolls_back_only_itself(self):
+        import transaction
+        from org.bccvl.testsetup.journal import read_journal
+
+        names = ['one', 'two', 'three', 'bad', 'four']
+        section = self.commit(self.folders(names, fail='bad'), every=2)
+        processed = []
+        with self.assertRaises(ValueError):
+            for item in section:
+                processed.append(item['_path'])
+        transaction.abort()
+
+        self.assertEqual(processed, ['one', 'two', 'three'])
+        # the first batch and what came before the bad item are committed
+        for name in ('one', 'two', 'three'):
+            self.assertTrue(name in self.portal, name)
+        # the bad item is rolled back, the run ends with it
+        self.assertFalse('bad' in self.portal)
+        self.assertFalse('four' in self.portal)
+        self.assertEqual(read_journal(self.journal),
+                         set(['one', 'two', 'three']))
+
+    def test_conflict_aborts_batch(self):
+        import transaction
+        from ZODB.POSException import ConflictError
+        from org.bccvl.testsetup.journal import read_journal
+
+        def conflict():
+            raise ConflictError()
+
+        def fail(folder):
+            if folder.getId() == 'three':
+                transaction.get().addBeforeCommitHook(conflict)
+
+        names = ['one', 'two', 'three', 'four']
+        section = self.commit(self.folders(names, fail=fail), every=2)
+        with self.assertRaises(ConflictError):
+            list(section)
+
+        # the first batch is committed, the conflicting one is aborted
+        self.assertTrue('one' in self.portal)
+        self.assertTrue('two' in self.portal)
+        self.assertFalse('three' in self.portal)
+        self.assertFalse('four' in self.portal)
+        self.assertEqual(read_journal(self.journal), set(['one', 'two']))
+        # and a new transaction can be committed
+        transaction.commit()
+
+
+@unittest.skipIf(BCCVL_TESTSETUP_FUNCTIONAL_TESTING is None,
+                 'plone.app.testing and org.bccvl.site are required')
+class Test_EnsureFolders(unittest.TestCase):
+
+    layer = BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        from plone.app.testing import TEST_USER_ID, setRoles
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+
+    def test_folders_created_once(self):
+        from Acquisition import aq_base
+        from zope.component import getGlobalSiteManager
+        from zope.interface import Interface
+        from zope.lifecycleevent.interfaces import IObjectAddedEvent
+        from org.bccvl.testsetup.transmogrify import (
+            clear_run_cache, ensure_folders, get_object)
+
+        site_path = '/'.join(self.portal.getPhysicalPath())
+        added = []
+
+        def handler(obj, event):
+            added.append('/'.join(obj.getPhysicalPath())[len(site_path) + 1:])
+
+        paths = ['ensure/a/b', 'ensure/a/c', 'ensure/a/b', 'ensure/d']
+        required = (Interface, IObjectAddedEvent)
+        gsm = getGlobalSiteManager()
+        gsm.registerHandler(handler, required)
+        try:
+            self.assertEqual(ensure_folders(self.portal, paths), 5)
+            # folders are known for the rest of the run
+            self.assertEqual(ensure_folders(self.portal, paths + ['ensure']), 0)
+            self.assertTrue(aq_base(get_object(self.portal, 'ensure/a/b')) is
+                            aq_base(self.portal['ensure']['a']['b']))
+            clear_run_cache(self.portal)
+            # a new run finds them
+            self.assertEqual(ensure_folders(self.portal, paths), 0)
+        finally:
+            gsm.unregisterHandler(handler, required)
+            clear_run_cache(self.portal)
+        self.assertEqual(sorted(added), [
+            'ensure', 'ensure/a', 'ensure/a/b', 'ensure/a/c', 'ensure/d'])
+
+
+@unittest.skipIf(BCCVL_TESTSETUP_FUNCTIONAL_TESTING is None,
+                 'plone.app.testing and org.bccvl.site are required')
+class Test_UpdateMetadata(unittest.TestCase):
+
+    layer = BCCVL_TESTSETUP_FUNCTIONAL_TESTING
+
+    def setUp(self):
+        from plone.app.testing import TEST_USER_ID, setRoles
+        self.portal = self.layer['portal']
+        setRoles(self.portal, TEST_USER_ID, ['Manager'])
+
+    def test_parallel_sync(self):
+        import threading
+        import transaction
+        from plone import api
+        from org.bccvl.testsetup import testing
+        from org.bccvl.testsetup.transmogrify import UpdateMetadata, clear_run_cache
+
+        items = [make_item('parallel{0}.zip'.format(num)) for num in range(6)]
+        for item in items:
+            api.content.create(
+                container=self.portal.unrestrictedTraverse('datasets'),
+                type=item['_type'], id=item['_path'].rsplit('/', 1)[1],
+                title=item['title'], remoteUrl=item['remoteUrl'],
+                dataSource=item['dataSource'], safe_id=False)
+        transaction.commit()
+
+        del testing.UPDATED[:]
+        testing.UPDATE_THREADS.clear()
+        section = UpdateMetadata(StubTransmogrifier(self.portal), 'updatemetadata', {
+            'siteurl': self.portal.absolute_url(),
+            'sync': 'True',
+            'parallel': '3',
+        }, iter([dict(item) for item in items]))
+        try:
+            self.assertEqual(len(list(section)), 6)
+            # nothing runs before the batch is committed
+            self.assertEqual(testing.UPDATED, [])
+            transaction.commit()
+        finally:
+            clear_run_cache(self.portal)
+        self.assertEqual(len(testing.UPDATED), 6)
+        # all of them ran on pool threads
+        self.assertFalse(threading.current_thread().ident in testing.UPDATE_THREADS)
+
+    def test_cached_metadata_completes_job(self):
+        import transaction
+        from plone import api
+        from zope.annotation import IAnnotations
+        from org.bccvl.site.job.interfaces import IJobTracker
+        from org.bccvl.testsetup import testing
+        from org.bccvl.testsetup.transmogrify import (
+            METADATA_KEY, UpdateMetadata, clear_run_cache, metadata_cache,
+            metadata_key)
+
+        item = make_item('cached.zip')
+        item['_remote'] = {'etag': 'abc', 'size': 10}
+        obj = api.content.create(
+            container=self.portal.unrestrictedTraverse('datasets'),
+            type=item['_type'], id='cached.zip', title=item['title'],
+            remoteUrl=item['remoteUrl'], dataSource=item['dataSource'],
+            safe_id=False)
+        key = metadata_key(item['remoteUrl'], item['_remote'])
+        metadata_cache(self.portal)[key] = {'genre': 'DataGenreCC'}
+
+        del testing.UPDATED[:]
+        section = UpdateMetadata(StubTransmogrifier(self.portal), 'updatemetadata', {
+            'siteurl': self.portal.absolute_url(),
+            'sync': 'True',
+        }, iter([dict(item)]))
+        try:
+            result = list(section)
+            transaction.commit()
+        finally:
+            clear_run_cache(self.portal)
+        self.assertEqual(result[0]['bccvlmetadata'], {'genre': 'DataGenreCC'})
+        # no task, but the object counts as updated
+        self.assertEqual(testing.UPDATED, [])
+        self.assertEqual(IJobTracker(obj).state, 'COMPLETED')
+        self.assertEqual(IAnnotations(obj)[METADATA_KEY], key)
@@ -0,0 +1,120 @@
+import io
+import json
+import os
+import threading
+import unittest
+import zipfile
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+from org.bccvl.testsetup.remote import RemoteClient
+from org.bccvl.testsetup.zipprobe import layers_from_metadata, list_members, probe
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serve server.files with support for single byte ranges"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        data = self.server.files[self.path]
+        byterange = self.headers.get('Range')
+        self.server.ranges.append(byterange)
+        start, end = 0, len(data) - 1
+        if byterange:
+            first, last = byterange[len('bytes='):].split('-')
+            if not first:
+                start = max(0, len(data) - int(last))
+            else:
+                start = int(first)
+                if last:
+                    end = min(end, int(last))
+        body = data[start:end + 1]
+        self.send_response(206 if byterange else 200)
+        if byterange:
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'.format(
+                start, end, len(data)))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class RangeServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), RangeHandler)
+        self.files = {}
+        self.ranges = []
+
+
+def make_zip(padding):
+    buf = io.BytesIO()
+    zf = zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED)
+    zf.writestr('current/data/bioclim_01.tif', b'\x00' * padding)
+    zf.writestr('current/data/bioclim_12.tif', b'\x01' * 100)
+    zf.writestr('current/bccvl/metadata.json', json.dumps({
+        'title': 'current',
+        'files': {
+            'data/bioclim_01.tif': {'layer': 'B01', 'type': 'continuous'},
+            'data/bioclim_12.tif': {'layer': 'B12', 'type': 'continuous'},
+        }
+    }))
+    zf.close()
+    return buf.getvalue()
+
+
+class Test_ZipProbe(unittest.TestCase):
+
+    def setUp(self):
+        self.server = RangeServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.root = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+        self.client = RemoteClient(backoff=0)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_probe(self):
+        self.server.files['/current.zip'] = make_zip(1000)
+        result = probe(self.client, self.root + '/current.zip')
+        self.assertEqual(result['files'], {
+            'current/data/bioclim_01.tif': 1000,
+            'current/data/bioclim_12.tif': 100,
+            'current/bccvl/metadata.json': len(json.dumps(result['metadata'])),
+        })
+        self.assertEqual(result['metadata']['title'], 'current')
+        layers = layers_from_metadata(result['metadata'], result['files'])
+        self.assertEqual(layers['B12'], {
+            'filename': 'current/data/bioclim_12.tif',
+            'datatype': 'continuous',
+            'layer': 'B12',
+            'size': 100,
+        })
+
+    def test_large_archive(self):
+        # only the tail of the file is fetched
+        big = io.BytesIO()
+        zf = zipfile.ZipFile(big, 'w', zipfile.ZIP_STORED)
+        zf.writestr('big.bin', os.urandom(200000))
+        zf.writestr('small.txt', b'small')
+        zf.close()
+        self.server.files['/big.zip'] = big.getvalue()
+        members = list_members(self.client, self.root + '/big.zip')
+        self.assertEqual([(m['filename'], m['size']) for m in members],
+                         [('big.bin', 200000), ('small.txt', 5)])
+        self.assertEqual(len(self.server.ranges), 1)
+        self.assertTrue(self.server.ranges[0].startswith('bytes=-'))
@@ -1,20 +1,41 @@
-from itertools import product
+import copy
+import hashlib
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import os.path
+import posixpath
+import zlib
 
+from Acquisition import aq_base
+from BTrees.OOBTree import OOBTree
+from celery import group
 from collective.transmogrifier.interfaces import ISectionBlueprint
 from collective.transmogrifier.interfaces import ISection
 from collective.transmogrifier.utils import defaultMatcher
 from plone import api
 from plone.app.textfield.value import RichTextValue
+from Products.CMFCore.utils import getToolByName
+from plone.uuid.interfaces import IUUID
 from zope.annotation import IAnnotations
 from zope.interface import implementer, provider
 from zope.component import getUtility
 from zope.schema.interfaces import IVocabularyFactory
-
+from ZODB.POSException import ConflictError
+import transaction
+
+from org.bccvl.testsetup.catalogue import get_index
+from org.bccvl.testsetup.itemstream import ItemWriter, read_items
+from org.bccvl.testsetup.journal import append_journal, read_journal
+from org.bccvl.testsetup.profiling import Profiler
+from org.bccvl.testsetup.remote import RemoteClient, head_objects, load_cache, save_cache
+from org.bccvl.testsetup.sharing import freeze
+from org.bccvl.testsetup.zipprobe import layers_from_metadata, probe
 from org.bccvl.tasks.celery import app
 from org.bccvl.tasks.plone import after_commit_task
+from org.bccvl.site import defaults
+from org.bccvl.site.interfaces import IBCCVLMetadata
 from org.bccvl.site.job.interfaces import IJobTracker
 
 
@@ -31,19 +52,515 @@ MARINE_DATASET_TAG = "Marine datasets"
 CURRENT_DATASET_TAG = "Current datasets"
 FUTURE_DATASET_TAG = "Future datasets"
 
+# portal types of datasets, all other items are containers
+DATASET_TYPES = ('org.bccvl.content.dataset', 'org.bccvl.content.remotedataset')
+
+# request annotation key for caches shared by sections during a run
+RUN_CACHE_KEY = 'org.bccvl.testsetup.runcache'
+
+# annotation key to store the fingerprint of the item an object was
+# imported from
+FINGERPRINT_KEY = 'org.bccvl.testsetup.fingerprint'
+
+# keys sections of the pipeline add to items; they are left out of the
+# item fingerprint, changes of remote objects are tracked on their own
+TRANSIENT_KEYS = ('_fingerprint', '_remote', '_remote_missing', '_zipfiles')
+
+# annotation key to store etag and size of the remote object an object
+# was imported with, if verifyremote checked it
+REMOTE_KEY = 'org.bccvl.testsetup.remote'
+
+# annotation key to store a hash per item key of the item an object was
+# imported from
+KEY_DIGESTS_KEY = 'org.bccvl.testsetup.keydigests'
+
+# catalog indexes depending on item keys, used to reindex only what
+# changed. None means all indexes; keys starting with '_' which are not
+# listed don't affect the catalog, any other key not listed means all
+# indexes.
+ITEM_INDEXES = {
+    'title': ('Title', 'sortable_title', 'SearchableText'),
+    'description': ('Description', 'SearchableText'),
+    'subject': ('Subject', 'SearchableText'),
+    'external_description': ('SearchableText', ),
+    'creators': ('Creator', ),
+    'remoteUrl': ('getRemoteUrl', ),
+    'format': (),
+    'dataSource': (),
+    'bccvlmetadata': None,
+    '_owner': ('Creator', 'allowedRolesAndUsers'),
+    # the workflow tool reindexes what it changes itself
+    '_transitions': (),
+}
+
+# indexes changed by scheduling a metadata update job
+JOB_INDEXES = ('job_state', 'modified')
+
+# cheap index reindexed to update catalog metadata only
+METADATA_INDEX = 'getId'
+
+# site annotation key of the metadata cache
+METADATA_CACHE_KEY = 'org.bccvl.testsetup.metadatacache'
+
+# annotation key to store the metadata cache key an object's metadata
+# update has been scheduled for
+METADATA_KEY = 'org.bccvl.testsetup.metadatakey'
+
+
+def run_cache(context, name):
+    """Return a dict to cache values for the duration of an import run
+
+    Caches live on the request and are dropped with clear_run_cache once
+    the run is finished.
+    """
+    caches = IAnnotations(context.REQUEST).setdefault(RUN_CACHE_KEY, {})
+    return caches.setdefault(name, {})
+
+
+def clear_run_cache(context):
+    IAnnotations(context.REQUEST).pop(RUN_CACHE_KEY, None)
+
+
+def get_object(context, path):
+    """Return object at site relative path, remembered for the run"""
+    path = path.encode().strip('/')
+    objects = run_cache(context, 'objects')
+    obj = objects.get(path)
+    if obj is None:
+        obj = context.unrestrictedTraverse(path, None)
+        if obj is not None:
+            objects[path] = obj
+    return obj
+
+
+def ensure_folders(context, paths, portal_type='Folder'):
+    """Look up or create the folders at site relative paths
+
+    Missing parents are created as well. Each folder is traversed to or
+    created once; all of them are remembered in the run cache, so that
+    get_object serves them from there. Returns the number of folders
+    created.
+    """
+    objects = run_cache(context, 'objects')
+    created = run_cache(context, 'created')
+    folders = set()
+    for path in paths:
+        path = path.encode('ASCII').strip('/')
+        while path and path not in folders:
+            folders.add(path)
+            path = posixpath.dirname(path)
+    count = 0
+    # parents sort before their children
+    for path in sorted(folders):
+        if path in objects:
+            continue
+        parent, id = posixpath.split(path)
+        container = objects.get(parent, context) if parent else context
+        if getattr(aq_base(container), id, None) is not None:
+            objects[path] = getattr(container, id)
+            continue
+        obj = api.content.create(container=container, type=portal_type,
+                                 id=id, title=id, safe_id=False)
+        if api.content.get_state(container, None) == 'published':
+            api.content.transition(obj, to_state='published')
+        objects[path] = obj
+        created[path] = True
+        count += 1
+    if count:
+        LOG.info('Created %d folders', count)
+    return count
+
+
+def get_vocabulary(context, name):
+    """Look up vocabulary by name, built only once per import run"""
+    vocabs = run_cache(context, 'vocabularies')
+    if name not in vocabs:
+        vocabs[name] = getUtility(IVocabularyFactory, name)(context)
+    return vocabs[name]
+
+
+def vocab_title(context, name, value):
+    vocab = get_vocabulary(context, name)
+    if value in vocab:
+        return vocab.getTerm(value).title
+    raise Exception("Invalid key {} for vocabulary {}".format(value, name))
+
 
 def emsc_title(context, emsc):
-    emsc_vocab = getUtility(IVocabularyFactory, 'emsc_source')(context)
-    if emsc in emsc_vocab:
-        return emsc_vocab.getTerm(emsc).title
-    raise Exception("Invalid key {} for emission scenario".format(emsc))
+    return vocab_title(context, 'emsc_source', emsc)
+
+
+def metadata_cache(site):
+    """Return cache of metadata update results, see metadata_key"""
+    annots = IAnnotations(site)
+    if METADATA_CACHE_KEY not in annots:
+        annots[METADATA_CACHE_KEY] = OOBTree()
+    return annots[METADATA_CACHE_KEY]
+
+
+def metadata_key(url, remote):
+    """Return key for the metadata of the remote object at url
+
+    remote is the object info added by the verifyremote section. Without
+    an etag the object can't be identified and None is returned.
+    """
+    if not (remote and remote.get('etag')):
+        return None
+    return '{0} {1} {2}'.format(url, remote['etag'], remote.get('size'))
+
+
+def shard_of(path, shards):
+    """Return the shard, out of shards, the item at path belongs to"""
+    if not isinstance(path, bytes):
+        path = path.encode('utf-8')
+    return (zlib.crc32(path) & 0xffffffff) % shards
+
+
+def chunked(iterable, size):
+    """Generate lists of up to size items from iterable"""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def value_digest(value):
+    """Return a stable hash over value"""
+    data = json.dumps(value, sort_keys=True, default=repr)
+    return hashlib.sha1(data).hexdigest()
+
+
+def item_fingerprint(item):
+    """Return a stable hash over all values of a generated item.
+
+    Transient keys are left out, so that the fingerprint is the same
+    whichever optional sections ran before.
+    """
+    return value_digest(dict((key, value) for key, value in item.items()
+                             if key not in TRANSIENT_KEYS))
+
+
+def remote_digest(remote):
+    """Return etag and size of remote object info found by verifyremote
+
+    Returns None if the object isn't known.
+    """
+    if not (remote and remote.get('etag')):
+        return None
+    return '{0} {1}'.format(remote['etag'], remote.get('size'))
+
+
+def is_unchanged(obj, item, fingerprint):
+    """Return whether obj has been imported from an item like this one
+
+    The remote objects are compared as well if they have been checked
+    both now and when obj was imported. Datasets also need a completed
+    metadata update; the fingerprint is stored when the update is only
+    scheduled, and a failed update has to be retried.
+    """
+    annots = IAnnotations(obj, None) if obj is not None else None
+    if annots is None or annots.get(FINGERPRINT_KEY) != fingerprint:
+        return False
+    if item.get('_type') in DATASET_TYPES:
+        tracker = IJobTracker(obj, None)
+        if tracker is None or tracker.state != 'COMPLETED':
+            return False
+    remote = remote_digest(item.get('_remote'))
+    stored = annots.get(REMOTE_KEY)
+    return not (remote and stored and remote != stored)
+
+
+def item_key_digests(item):
+    """Return a hash for the value of each key of item"""
+    return dict((key, value_digest(value)) for key, value in item.items())
+
+
+def changed_indexes(item, digests):
+    """Return indexes affected by changes of item since digests were taken
+
+    Returns None if all indexes are affected.
+    """
+    idxs = set()
+    for key, digest in item_key_digests(item).items():
+        if digests.get(key) == digest:
+            continue
+        if key not in ITEM_INDEXES:
+            if key.startswith('_'):
+                continue
+            return None
+        if ITEM_INDEXES[key] is None:
+            return None
+        idxs.update(ITEM_INDEXES[key])
+    return idxs
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class Fingerprint(object):
+    """Attach a fingerprint to each item and optionally drop unchanged items
+
+    In incremental mode items are dropped if the object at the item path
+    already carries the same fingerprint, and its remote object hasn't
+    changed (see is_unchanged), so that none of the expensive sections
+    further down the pipeline have to look at them.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.pathkey = defaultMatcher(options, 'path-key', name, 'path')
+        self.fingerprintkey = options.get('fingerprint-key', '_fingerprint')
+        self.incremental = options.get('incremental', "").lower() in (
+            "true", "1", "on", "yes")
+
+    def __iter__(self):
+        skipped = 0
+        for item in self.previous:
+            pathkey = self.pathkey(*item.keys())[0]
+            if not pathkey or not item[pathkey]:
+                yield item
+                continue
+
+            fingerprint = item_fingerprint(item)
+            item[self.fingerprintkey] = fingerprint
+            if not self.incremental:
+                yield item
+                continue
+
+            obj = get_object(self.context, item[pathkey])
+            if is_unchanged(obj, item, fingerprint):
+                # object exists and is up to date
+                skipped += 1
+                continue
+            yield item
+
+        if self.incremental:
+            LOG.info('Skipped %d unchanged items', skipped)
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class Shard(object):
+    """Pass on only the items of one shard of a parallel import
+
+    Dataset items are assigned to one of ``shards`` shards by a hash of
+    their path, and only those of shard ``shard`` (counted from 0) are
+    passed on. ``containers`` decides what happens to all other items:
+    ``keep`` them, ``drop`` them, or pass on ``only`` them and no datasets.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.pathkey = defaultMatcher(options, 'path-key', name, 'path')
+        self.shards = int(options.get('shards', '0').strip() or 0)
+        self.shard = int(options.get('shard', '0').strip() or 0)
+        self.containers = options.get('containers', 'keep').strip()
+
+    def __iter__(self):
+        if not self.shards and self.containers == 'keep':
+            for item in self.previous:
+                yield item
+            return
+
+        for item in self.previous:
+            if item.get('_type') in DATASET_TYPES:
+                if self.containers == 'only':
+                    continue
+                pathkey = self.pathkey(*item.keys())[0]
+                if (self.shards and pathkey and
+                        shard_of(item[pathkey], self.shards) != self.shard):
+                    continue
+            elif self.containers == 'drop':
+                continue
+            yield item
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class VerifyRemote(object):
+    """Check that the remote objects of items exist
+
+    Items are collected in chunks of ``chunk-size``, and the remote urls of
+    each chunk are requested with HEAD concurrently. Items whose remote
+    object is missing are dropped, or with ``missing = flag`` passed on
+    with ``_remote_missing`` set. All other remote items get etag, size
+    and last_modified of their object as ``_remote``. Object infos are
+    kept in the json file ``cache`` between runs.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.enabled = options.get('enabled', "").lower() in (
+            "true", "1", "on", "yes")
+        self.urlkey = options.get('url-key', 'remoteUrl').strip()
+        self.missing = options.get('missing', 'drop').strip()
+        self.cache = options.get('cache', '').strip()
+        self.chunksize = int(options.get('chunk-size', '200').strip() or 200)
+        self.workers = int(options.get('workers', '8').strip() or 8)
+        self.perhost = int(options.get('per-host', '4').strip() or 4)
+
+    def __iter__(self):
+        if not self.enabled:
+            for item in self.previous:
+                yield item
+            return
+
+        client = RemoteClient(per_host=self.perhost, workers=self.workers)
+        cache = load_cache(self.cache) if self.cache else {}
+        try:
+            for chunk in chunked(self.previous, self.chunksize):
+                for item in self.verify(client, cache, chunk):
+                    yield item
+        finally:
+            client.close()
+        if self.cache:
+            save_cache(self.cache, cache)
+
+    def verify(self, client, cache, items):
+        urls = set(item[self.urlkey] for item in items if item.get(self.urlkey))
+        found = head_objects(client, sorted(urls), cache)
+        for item in items:
+            url = item.get(self.urlkey)
+            if url not in found:
+                # not a remote item, or couldn't check it
+                yield item
+                continue
+            if found[url] is None:
+                if self.missing == 'flag':
+                    LOG.warning('Remote object %s of %s is missing',
+                                url, item.get('_path'))
+                    item['_remote_missing'] = True
+                    yield item
+                else:
+                    LOG.error('Dropping %s, remote object %s is missing',
+                              item.get('_path'), url)
+                continue
+            item['_remote'] = found[url]
+            yield item
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class Resume(object):
+    """Drop items already imported by an earlier, interrupted run
+
+    Items are dropped if their path has been recorded in ``journal`` by
+    the commit section.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.pathkey = defaultMatcher(options, 'path-key', name, 'path')
+        self.enabled = options.get('enabled', "").lower() in (
+            "true", "1", "on", "yes")
+        self.journal = options.get('journal', '').strip()
+
+    def __iter__(self):
+        if not (self.enabled and self.journal):
+            for item in self.previous:
+                yield item
+            return
+
+        done = read_journal(self.journal)
+        LOG.info('Resuming import, %d items in journal %s',
+                 len(done), self.journal)
+        skipped = 0
+        for item in self.previous:
+            pathkey = self.pathkey(*item.keys())[0]
+            if pathkey and item[pathkey] in done:
+                skipped += 1
+                continue
+            yield item
+        LOG.info('Skipped %d items imported by a previous run', skipped)
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class StoreFingerprint(object):
+    """Store the item fingerprint on the imported object
+
+    A hash of each item value is stored as well, so that deferredreindex
+    can tell which values have changed on the next import, and etag and
+    size of the remote object if verifyremote checked it.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.pathkey = defaultMatcher(options, 'path-key', name, 'path')
+        self.fingerprintkey = options.get('fingerprint-key', '_fingerprint')
+
+    def __iter__(self):
+        for item in self.previous:
+            pathkey = self.pathkey(*item.keys())[0]
+            fingerprint = item.get(self.fingerprintkey)
+            if not (pathkey and item[pathkey] and fingerprint):
+                yield item
+                continue
+
+            obj = get_object(self.context, item[pathkey])
+            annots = IAnnotations(obj, None) if obj is not None else None
+            if annots is None:
+                yield item
+                continue
+            if annots.get(FINGERPRINT_KEY) != fingerprint:
+                annots[FINGERPRINT_KEY] = fingerprint
+            remote = remote_digest(item.get('_remote'))
+            if remote and annots.get(REMOTE_KEY) != remote:
+                annots[REMOTE_KEY] = remote
+            digests = item_key_digests(item)
+            if annots.get(KEY_DIGESTS_KEY) != digests:
+                annots[KEY_DIGESTS_KEY] = digests
+            yield item
 
 
 @provider(ISectionBlueprint)
 @implementer(ISection)
 class UpdateMetadata(object):
-    """Trigger task to update file metadata on imported item"""
-    # TODO: have option to run in process or async
+    """Trigger task to update file metadata on imported item
+
+    By default one task is scheduled per item after commit. With
+    ``parallel`` > 1 all tasks of a transaction are collected and
+    dispatched once it has been committed: as celery groups of
+    ``parallel`` tasks, or in process (``sync``) on a pool of ``parallel``
+    threads. Eager tasks open the site through a connection of their
+    own in the worker thread; nothing of the committing thread's
+    connection is shared. The jobs of failed tasks are then set to FAILED
+    in one transaction per batch, on a private connection.
+
+    Results are cached per remote object (url, etag and size, as found by
+    verifyremote). If an unchanged object has been processed before, its
+    metadata is merged into the item's ``bccvlmetadata`` instead of
+    running the task again, and the object gets a COMPLETED job. Layers listed by zipprobe only pre-fill the
+    item; the task still runs to extract the full raster metadata.
+    """
 
     def __init__(self, transmogrifier, name, options, previous):
         self.transmogrifier = transmogrifier
@@ -55,10 +572,98 @@ class UpdateMetadata(object):
         # keys for sections further down the chain
         self.pathkey = defaultMatcher(options, 'path-key', name, 'path')
         self.siteurl = options.get('siteurl')
-        sync = options.get('sync', 'False').strip(
+        self.sync = options.get('sync', 'False').strip(
         ).lower() not in ('false', '0')
-        if sync:
+        if self.sync:
             app.conf['CELERY_ALWAYS_EAGER'] = True
+        self.parallel = int(options.get('parallel', '1').strip() or 1)
+        self.context_path = self.context.getPhysicalPath()
+
+        # get username
+        member = api.user.get_current()
+        # do we have a propery member?
+        if member.getId():
+            self.user = {
+                'id': member.getUserName(),
+                'email': member.getProperty('email'),
+                'fullname': member.getProperty('fullname')
+            }
+        else:
+            # assume admin for background task
+            self.user = {
+                'id': 'admin',
+                'email': None,
+                'fullname': None
+            }
+        # tasks collected for the current transaction
+        self._txn = None
+        self._tasks = None
+        # number of items which got cached metadata
+        self.cached = 0
+
+    def schedule(self, task):
+        if self.parallel <= 1:
+            after_commit_task(task)
+            return
+        txn = transaction.get()
+        if txn is not self._txn:
+            self._txn = txn
+            self._tasks = []
+            txn.addAfterCommitHook(self.dispatch, args=(self._tasks, ))
+        self._tasks.append(task)
+
+    def dispatch(self, success, tasks):
+        if not (success and tasks):
+            return
+        if not self.sync:
+            for chunk in chunked(tasks, self.parallel):
+                group(chunk).apply_async()
+            LOG.info('Dispatched %d metadata update tasks in groups of %d',
+                     len(tasks), self.parallel)
+            return
+        # runs in an after commit hook; worker threads have transaction
+        # managers of their own. Failures are collected, not raised
+        pool = ThreadPool(min(self.parallel, len(tasks)))
+        try:
+            results = pool.map(lambda task: task.apply(throw=False), tasks)
+        finally:
+            pool.close()
+            pool.join()
+        failed = [(task, result) for task, result in zip(tasks, results)
+                  if result.failed()]
+        for task, result in failed:
+            LOG.error('Metadata update of %s failed: %s',
+                      task.kwargs['context']['context'], result.result)
+        if failed:
+            self.write_failed(failed)
+        LOG.info('Ran %d metadata update tasks (%d failed)',
+                 len(results), len(failed))
+
+    def write_failed(self, failed):
+        """Set jobs of failed tasks to FAILED in one transaction
+
+        The transaction of the dispatching thread has just been committed,
+        so a private connection is used.
+        """
+        manager = transaction.TransactionManager()
+        conn = self.context._p_jar.db().open(transaction_manager=manager)
+        try:
+            app = conn.root()['Application']
+            for task, result in failed:
+                obj = app.unrestrictedTraverse(
+                    task.kwargs['context']['context'], None)
+                if obj is None:
+                    continue
+                IJobTracker(obj).set_progress(
+                    'FAILED', 'Metadata update failed: {0}'.format(result.result))
+                obj.reindexObject(idxs=list(JOB_INDEXES))
+            manager.commit()
+        except Exception:
+            manager.abort()
+            LOG.exception('Failed to record %d failed metadata updates',
+                          len(failed))
+        finally:
+            conn.close()
 
     def __iter__(self):
         for item in self.previous:
@@ -85,36 +690,17 @@ class UpdateMetadata(object):
                 yield item
                 continue
 
-            obj = self.context.unrestrictedTraverse(
-                path.encode().lstrip('/'), None)
+            obj = get_object(self.context, path)
 
             # path doesn't exist
             if obj is None:
                 yield item
                 continue
 
-            # get username
-            member = api.user.get_current()
-            # do we have a propery member?
-            if member.getId():
-                user = {
-                    'id': member.getUserName(),
-                    'email': member.getProperty('email'),
-                    'fullname': member.getProperty('fullname')
-                }
-            else:
-                # assume admin for background task
-                user = {
-                    'id': 'admin',
-                    'email': None,
-                    'fullname': None
-                }
-
             # build download url
             # 1. get context (site) relative path
-            context_path = self.context.getPhysicalPath()
-            obj_path = obj.getPhysicalPath()
-            obj_path = '/'.join(obj_path[len(context_path):])
+            physical_path = obj.getPhysicalPath()
+            obj_path = '/'.join(physical_path[len(self.context_path):])
             if obj.portal_type == 'org.bccvl.content.dataset':
                 filename = obj.file.filename
                 obj_url = '{}/{}/@@download/file/{}'.format(
@@ -133,6 +719,25 @@ class UpdateMetadata(object):
             if 'external_description' in item:
                 obj.external_description = RichTextValue(item['external_description'])
 
+            key = None
+            if obj.portal_type == 'org.bccvl.content.remotedataset':
+                key = metadata_key(obj.remoteUrl, item.get('_remote'))
+            if key:
+                metadata = self.cached_metadata(obj, key)
+                if metadata is not None:
+                    metadata = dict(metadata)
+                    metadata.update(item.get('bccvlmetadata') or {})
+                    item['bccvlmetadata'] = metadata
+                    self.cached += 1
+                    if not (IAnnotations(obj).get(METADATA_KEY) == key and
+                            IJobTracker(obj).state == 'COMPLETED'):
+                        # the object is as good as updated
+                        IAnnotations(obj)[METADATA_KEY] = key
+                        self.track(obj, 'COMPLETED', 'Metadata reused from cache')
+                    yield item
+                    continue
+                IAnnotations(obj)[METADATA_KEY] = key
+
             # schedule metadata update task in process
             # FIXME: do we have obj.format already set?
             update_task = app.signature(
@@ -142,21 +747,620 @@ class UpdateMetadata(object):
                     'filename': filename,
                     'contenttype': obj.format,
                     'context': {
-                        'context': '/'.join(obj.getPhysicalPath()),
-                        'user': user,
+                        'context': '/'.join(physical_path),
+                        'user': self.user,
                     }
                 },
                 immutable=True)
 
-            after_commit_task(update_task)
-            # track background job state
-            jt = IJobTracker(obj)
-            job = jt.new_job('TODO: generate id',
-                             'generate taskname: update_metadata',
-                             function=obj.dataSource,
-                             type=obj.portal_type)
-            jt.set_progress('PENDING', 'Metadata update pending')
+            self.schedule(update_task)
+            self.track(obj, 'PENDING', 'Metadata update pending')
+
+            yield item
+
+        if self.cached:
+            LOG.info('Reused cached metadata for %d items', self.cached)
+
+    def track(self, obj, state, message):
+        # track background job state
+        jt = IJobTracker(obj)
+        job = jt.new_job('TODO: generate id',
+                         'generate taskname: update_metadata',
+                         function=obj.dataSource,
+                         type=obj.portal_type)
+        jt.set_progress(state, message)
+        # job_state needs reindexing even if nothing else changed
+        run_cache(self.context, 'jobs')['/'.join(obj.getPhysicalPath())] = True
+
+    def cached_metadata(self, obj, key):
+        cache = metadata_cache(self.context)
+        if key in cache:
+            return cache[key]
+        # harvest the result of a completed update of an earlier run
+        if (IAnnotations(obj).get(METADATA_KEY) == key and
+                IJobTracker(obj).state == 'COMPLETED'):
+            metadata = copy.deepcopy(dict(IBCCVLMetadata(obj)))
+            cache[key] = metadata
+            return metadata
+        return None
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class ZipProbe(object):
+    """Fill in layer listings from the central directory of remote zips
+
+    The central directories of the zips of a chunk of items are read
+    concurrently with range requests. The files in a zip are added to the
+    item as ``_zipfiles``, and layers listed in its bundled bccvl metadata
+    as ``bccvlmetadata['layers']``, unless the item has layers already or
+    its metadata is cached. The listing is available right away; it only
+    holds file names, data types and sizes, so updatemetadata still runs
+    its task to extract the full layer metadata.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.enabled = options.get('enabled', "").lower() in (
+            "true", "1", "on", "yes")
+        self.urlkey = options.get('url-key', 'remoteUrl').strip()
+        self.chunksize = int(options.get('chunk-size', '50').strip() or 50)
+        self.workers = int(options.get('workers', '8').strip() or 8)
+        self.perhost = int(options.get('per-host', '4').strip() or 4)
+
+    def probeable(self, item):
+        url = item.get(self.urlkey)
+        if not (url and url.endswith('.zip') and
+                not item.get('_remote_missing') and
+                not (item.get('bccvlmetadata') or {}).get('layers')):
+            return False
+        # updatemetadata has the metadata of unchanged zips already
+        key = metadata_key(url, item.get('_remote'))
+        return not (key and key in metadata_cache(self.context))
 
+    def __iter__(self):
+        if not self.enabled:
+            for item in self.previous:
+                yield item
+            return
+
+        client = RemoteClient(per_host=self.perhost, workers=self.workers)
+        try:
+            for chunk in chunked(self.previous, self.chunksize):
+                for item in self.probe_chunk(client, chunk):
+                    yield item
+        finally:
+            client.close()
+
+    def probe_chunk(self, client, chunk):
+        urls = sorted(set(item[self.urlkey] for item in chunk
+                          if self.probeable(item)))
+        results = {}
+        for url, result, error in client.map(
+                lambda url: probe(client, url), urls):
+            if error is not None:
+                LOG.warning('Failed to probe %s: %s', url, error)
+                continue
+            results[url] = result
+
+        for item in chunk:
+            result = results.get(item.get(self.urlkey))
+            if result is not None and self.probeable(item):
+                item['_zipfiles'] = result['files']
+                layers = layers_from_metadata(result['metadata'],
+                                              result['files'])
+                if layers:
+                    item.setdefault('bccvlmetadata', {})['layers'] = layers
+            yield item
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class Constructor(object):
+    """Construct content objects
+
+    Works like collective.transmogrifier's constructor, but records the
+    objects it finds or creates, so that later sections can look them up
+    with get_object instead of traversing to them again. Paths of created
+    objects are recorded in the run cache 'created'.
+
+    With ``create-containers`` missing containers are created as folders
+    of type ``container-type`` instead of skipping their items.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.ttool = getToolByName(self.context, 'portal_types')
+        self.typekey = defaultMatcher(options, 'type-key', name, 'type',
+                                      ('portal_type', 'Type'))
+        self.pathkey = defaultMatcher(options, 'path-key', name, 'path')
+        self.required = bool(options.get('required'))
+        self.createcontainers = options.get('create-containers', "").lower() in (
+            "true", "1", "on", "yes")
+        self.containertype = options.get('container-type', 'Folder').strip()
+
+    def __iter__(self):
+        objects = run_cache(self.context, 'objects')
+        created = run_cache(self.context, 'created')
+        for item in self.previous:
+            keys = item.keys()
+            typekey = self.typekey(*keys)[0]
+            pathkey = self.pathkey(*keys)[0]
+
+            if not (typekey and pathkey):
+                LOG.warn('Not enough info for item: %s', item)
+                yield item
+                continue
+
+            type_, path = item[typekey], item[pathkey]
+
+            fti = self.ttool.getTypeInfo(type_)
+            if fti is None:
+                LOG.warn('Not an existing type: %s', type_)
+                yield item
+                continue
+
+            path = path.encode('ASCII').strip('/')
+            container, id = posixpath.split(path)
+            context = get_object(self.context, container) if container else self.context
+            if context is None and self.createcontainers:
+                ensure_folders(self.context, [container], self.containertype)
+                context = get_object(self.context, container)
+            if context is None:
+                error = 'Container {} does not exist for item {}'.format(
+                    container, path)
+                if self.required:
+                    raise KeyError(error)
+                LOG.warn(error)
+                yield item
+                continue
+
+            if getattr(aq_base(context), id, None) is not None:
+                # item exists
+                objects[path] = getattr(context, id)
+                yield item
+                continue
+
+            obj = fti._constructInstance(context, id)
+            # For CMF <= 2.1 (aka Plone 3)
+            if hasattr(fti, '_finishConstruction'):
+                obj = fti._finishConstruction(obj)
+
+            if obj.getId() != id:
+                path = posixpath.join(container, obj.getId())
+                item[pathkey] = path
+            objects[path] = obj
+            created[path] = True
+
+            yield item
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class DeferredReindex(object):
+    """Reindex imported objects once per transaction
+
+    Objects are collected by UID and reindexed right before the
+    transaction is committed. Objects created by this import are
+    reindexed fully; for existing objects only the indexes depending on
+    item values that changed since the last import are updated (see
+    ITEM_INDEXES), plus JOB_INDEXES if updatemetadata scheduled a job for
+    them. Objects without changes aren't reindexed at all.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.pathkey = defaultMatcher(options, 'path-key', name, 'path')
+        self.catalog = getToolByName(self.context, 'portal_catalog')
+        # objects to reindex in the current transaction
+        self._txn = None
+        self._pending = None
+
+    def defer(self, obj, idxs):
+        txn = transaction.get()
+        if txn is not self._txn:
+            self._txn = txn
+            self._pending = {}
+            txn.addBeforeCommitHook(self.flush, args=(self._pending, ))
+        uid = IUUID(obj, None) or '/'.join(obj.getPhysicalPath())
+        path, pending = self._pending.get(uid, (None, set()))
+        if idxs is not None and pending is not None:
+            idxs = pending | idxs
+        else:
+            idxs = None
+        self._pending[uid] = ('/'.join(obj.getPhysicalPath()), idxs)
+
+    def flush(self, pending):
+        valid = set(self.catalog.indexes())
+        full = partial = 0
+        for path, idxs in pending.values():
+            # objects may have been rolled back since
+            obj = self.context.unrestrictedTraverse(path, None)
+            if obj is None:
+                continue
+            if idxs is None:
+                self.catalog.reindexObject(obj)
+                full += 1
+                continue
+            # an empty list would reindex everything
+            idxs = ([idx for idx in idxs if idx in valid] or
+                    [idx for idx in (METADATA_INDEX, ) if idx in valid])
+            if idxs:
+                self.catalog.reindexObject(obj, idxs=idxs)
+                partial += 1
+        LOG.info('Reindexed %d objects fully and %d partially', full, partial)
+
+    def __iter__(self):
+        created = run_cache(self.context, 'created')
+        jobs = run_cache(self.context, 'jobs')
+        for item in self.previous:
+            pathkey = self.pathkey(*item.keys())[0]
+            if not (pathkey and item[pathkey]):
+                yield item
+                continue
+
+            path = item[pathkey].encode('ASCII').strip('/')
+            obj = get_object(self.context, path)
+            if obj is None:
+                yield item
+                continue
+
+            digests = IAnnotations(obj, {}).get(KEY_DIGESTS_KEY)
+            if path in created or digests is None:
+                self.defer(obj, None)
+            else:
+                idxs = changed_indexes(item, digests)
+                if idxs is not None and '/'.join(obj.getPhysicalPath()) in jobs:
+                    idxs.update(JOB_INDEXES)
+                if idxs is None or idxs:
+                    self.defer(obj, idxs)
+            yield item
+
+
+def catalog_snapshot(context):
+    """Return physical paths of all content in the datasets folder
+
+    The snapshot is taken once per run.
+    """
+    snapshot = run_cache(context, 'catalogsnapshot')
+    if 'paths' not in snapshot:
+        pc = getToolByName(context, 'portal_catalog')
+        path = '/'.join(context.getPhysicalPath() + (defaults.DATASETS_FOLDER_ID, ))
+        snapshot['paths'] = set(
+            brain.getPath() for brain in pc.unrestrictedSearchResults(path=path))
+    return snapshot['paths']
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class ImportPlan(object):
+    """Count items which would be created, updated or skipped
+
+    Items are checked against a catalog snapshot and counted per
+    ``source``; none of them is passed on. In ``incremental`` mode
+    existing objects with an unchanged fingerprint count as skipped.
+
+    The Swift objects of created and updated items are summed up as
+    ``bytes``, with sizes looked up in the remote object ``cache`` of
+    verifyremote. With ``head`` enabled, objects which aren't cached are
+    requested with HEAD. Objects of unknown size are counted as
+    ``unknown``.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.pathkey = defaultMatcher(options, 'path-key', name, 'path')
+        self.source = options.get('source', name)
+        self.incremental = options.get('incremental', "").lower() in (
+            "true", "1", "on", "yes")
+        self.urlkey = options.get('url-key', 'remoteUrl').strip()
+        self.cache = options.get('cache', '').strip()
+        self.head = options.get('head', "").lower() in (
+            "true", "1", "on", "yes")
+        self.workers = int(options.get('workers', '8').strip() or 8)
+
+    def __iter__(self):
+        snapshot = catalog_snapshot(self.context)
+        site_path = '/'.join(self.context.getPhysicalPath())
+        counts = run_cache(self.context, 'importplan').setdefault(
+            self.source, {'create': 0, 'update': 0, 'skip': 0,
+                          'bytes': 0, 'unknown': 0})
+        # remote objects which would be transferred
+        urls = []
+        for item in self.previous:
+            pathkey = self.pathkey(*item.keys())[0]
+            if not pathkey or not item[pathkey]:
+                continue
+            path = item[pathkey].encode().strip('/')
+            if '/'.join((site_path, path)) not in snapshot:
+                counts['create'] += 1
+            elif (self.incremental and
+                  is_unchanged(get_object(self.context, path), item,
+                               item_fingerprint(item))):
+                counts['skip'] += 1
+                continue
+            else:
+                counts['update'] += 1
+            if item.get(self.urlkey):
+                urls.append(item[self.urlkey])
+        self.estimate(counts, urls)
+        # nothing is passed on
+        return iter(())
+
+    def estimate(self, counts, urls):
+        cache = load_cache(self.cache) if self.cache else {}
+        uncached = sorted(set(url for url in urls if url not in cache))
+        if self.head and uncached:
+            client = RemoteClient(workers=self.workers)
+            try:
+                head_objects(client, uncached, cache)
+            finally:
+                client.close()
+            if self.cache:
+                save_cache(self.cache, cache)
+        for url in urls:
+            size = (cache.get(url) or {}).get('size')
+            if size is None:
+                counts['unknown'] += 1
+            else:
+                counts['bytes'] += size
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class Buffer(object):
+    """Collect all items in the run cache instead of passing them on
+
+    Used by online imports, which generate all items first and feed them
+    to the rest of the pipeline in batches through batchsource. Items are
+    stored frozen, sharing equal values with each other; they have to be
+    thawed before they are processed any further.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+    def __iter__(self):
+        buffer = run_cache(self.context, 'buffer')
+        items = buffer.setdefault('items', [])
+        table = buffer.setdefault('shared', {})
+        items.extend(freeze(item, table) for item in self.previous)
+        # nothing is passed on
+        return iter(())
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class ExportItems(object):
+    """Write all items to the item stream ``file``
+
+    Used by --export to store the items generated by the sources, so that
+    they can be imported later on with --replay.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.filename = options['file'].strip()
+
+    def __iter__(self):
+        writer = ItemWriter(self.filename)
+        try:
+            for item in self.previous:
+                writer.write(item)
+                yield item
+        finally:
+            writer.close()
+        LOG.info('Exported %d items to %s', writer.count, self.filename)
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class ReplaySource(object):
+    """Yield the items stored in the item stream ``file``"""
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.filename = options['file'].strip()
+
+    def __iter__(self):
+        for item in self.previous:
+            yield item
+        for item in read_items(self.filename):
+            yield item
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class BatchSource(object):
+    """Yield the batch of buffered items an online import is processing"""
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+    def __iter__(self):
+        for item in self.previous:
+            yield item
+
+        for item in run_cache(self.context, 'buffer').get('batch', ()):
+            yield item
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class Profile(object):
+    """Record timings of another section
+
+    Constructs the section from blueprint ``profile-blueprint`` and passes
+    on its items, recording how long it took to produce each of them. All
+    profiled sections of a run share one Profiler.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        blueprint = getUtility(ISectionBlueprint, options['profile-blueprint'])
+        self.section = blueprint(transmogrifier, name, options, previous)
+        self.profiler = run_cache(self.context, 'profile').setdefault(
+            'profiler', Profiler())
+
+    def __iter__(self):
+        return self.profiler.wrap(self.name, self.section)
+
+
+def pending_bytes(context):
+    """Estimate the size of uncommitted changes on the context's connection
+
+    Counts the data already written to savepoints plus the last known size
+    of objects registered as modified since.
+    """
+    conn = context._p_jar
+    size = sum(getattr(obj, '_p_estimated_size', 0)
+               for obj in getattr(conn, '_registered_objects', ()))
+    storage = getattr(conn, '_savepoint_storage', None)
+    if storage is not None:
+        size += getattr(storage, 'position', 0)
+    return size
+
+
+@provider(ISectionBlueprint)
+@implementer(ISection)
+class Commit(object):
+    """Commit the transaction in batches
+
+    A batch is committed after ``every`` items or as soon as the pending
+    changes exceed ``megabytes``, whichever comes first. Within a batch a
+    savepoint is taken after each item, so that a failing item can be
+    rolled back and the items processed before it still get committed.
+    The error is re-raised though: one bad item still ends the run, and
+    the items after it are not processed at all. A batch which fails to
+    commit with a ConflictError is aborted as a whole before the error is
+    re-raised. With both options set to 0 nothing is committed here.
+
+    If ``journal`` is set, the paths of all items are appended to this file
+    once the transaction they have been processed in is committed.
+    """
+
+    def __init__(self, transmogrifier, name, options, previous):
+        self.transmogrifier = transmogrifier
+        self.context = transmogrifier.context
+        self.name = name
+        self.options = options
+        self.previous = previous
+
+        self.every = int(options.get('every', '0').strip() or 0)
+        self.maxbytes = float(
+            options.get('megabytes', '0').strip() or 0) * 1024 * 1024
+        self.pathkey = defaultMatcher(options, 'path-key', name, 'path')
+        self.journal = options.get('journal', '').strip()
+        # paths of items processed in the current transaction
+        self._txn = None
+        self._paths = None
+
+    def record(self, item):
+        pathkey = self.pathkey(*item.keys())[0]
+        if not (pathkey and item[pathkey]):
+            return
+        txn = transaction.get()
+        if txn is not self._txn:
+            self._txn = txn
+            self._paths = []
+            txn.addAfterCommitHook(self.write_journal, args=(self._paths, ))
+        self._paths.append(item[pathkey])
+
+    def write_journal(self, success, paths):
+        if success and paths:
+            append_journal(self.journal, paths)
+
+    def commit(self, count):
+        try:
+            transaction.commit()
+        except ConflictError:
+            # nothing of the batch has been written
+            LOG.error('Conflict committing batch of %d items', count)
+            transaction.abort()
+            raise
+
+    def __iter__(self):
+        if not (self.every or self.maxbytes):
+            for item in self.previous:
+                if self.journal:
+                    self.record(item)
+                yield item
+            return
+
+        count = 0
+        savepoint = None
+        iterator = iter(self.previous)
+        while True:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                break
+            except Exception:
+                # the failing item has left changes behind; throw them
+                # away and keep what has been done so far
+                if savepoint is not None:
+                    LOG.error('Import failed, committing %d items of '
+                              'current batch', count)
+                    savepoint.rollback()
+                    self.commit(count)
+                else:
+                    transaction.abort()
+                raise
+
+            if self.journal:
+                self.record(item)
+            count += 1
+            if ((self.every and count >= self.every) or
+                    (self.maxbytes and pending_bytes(self.context) >= self.maxbytes)):
+                self.commit(count)
+                LOG.info('Committed batch of %d items', count)
+                count = 0
+                savepoint = None
+            else:
+                savepoint = transaction.savepoint(optimistic=True)
             yield item
 
 
@@ -165,6 +1369,7 @@ class UpdateMetadata(object):
 @implementer(ISection)
 class FutureClimateLayer5k(object):
 
+    catalogue = 'a5ksource'
     resolution = 'Resolution2_5m'
     swiftcontainer = 'australia_5km'
     folder = 'australia/australia_5km'
@@ -172,6 +1377,11 @@ class FutureClimateLayer5k(object):
     current_title = "Australia, Current Climate (1976-2005), 2.5 arcmin (~5 km)"
     current_file = "current.zip"
     current_additional_tags = [SUMMARY_DATASET_TAG]
+    current_description = (
+        "Australia, current climate baseline of 1976 to 2005 - climate of 1990 - generated from aggregating monthly data from Australia Water Availability Project (AWAP; http://www.bom.gov.au/jsp/awap/). "
+        "These data were then aggregated to Bioclim variables according to the methodology of WorldClim www.worldclim.org/methods. "
+        "For the gridded Australian data sets which are 1-kilometer in resolution, the base layers (i.e. daily AWAP 5k grids) are the same as they are in the 5-kilometer resolution dataset. "
+        "The difference is that the final product (i.e. the aggregated data in the form of a Bioclim variable) is interpolated from 5k res to 1k res.")
 
     def __init__(self, transmogrifier, name, options, previous):
         self.transmogrifier = transmogrifier
@@ -200,46 +1410,21 @@ class FutureClimateLayer5k(object):
 
         # Generate new items based on source
         IAnnotations(self.context.REQUEST)['org.bccvl.site.stats.delay'] = True
-        # One way of doing it is having a hardcoded list here
-        # Generate new items based on source
-        # One way of doing it is having a hardcoded list here
-        emscs = ['RCP3PD', 'RCP45', 'RCP6', 'RCP85',
-                 'SRESA1B', 'SRESA1FI', 'SRESA2', 'SRESB1', 'SRESB2']
-        gcms = ['cccma-cgcm31', 'ccsr-miroc32hi', 'ccsr-miroc32med',
-                'cnrm-cm3', 'csiro-mk30', 'gfdl-cm20', 'gfdl-cm21',
-                'giss-modeleh', 'giss-modeler', 'iap-fgoals10g', 'inm-cm30',
-                'ipsl-cm4', 'mpi-echam5', 'mri-cgcm232a', 'ncar-ccsm30',
-                'ncar-pcm1', 'ukmo-hadcm3', 'ukmo-hadgem1']
-        years = ['2015', '2025', '2035', '2045', '2055',
-                 '2065', '2075', '2085']
-        for emsc, gcm, year in product(emscs, gcms, years):
-            if self.emsc and emsc not in self.emsc:
-                # Skip this emsc
-                continue
-            if self.gcm and gcm not in self.gcm:
-                # skip this gcm
-                continue
-            if self.year and year not in self.year:
-                # skip this year
-                continue
-            # don't skip, yield a new item
-            yield self.createItem(emsc, gcm, year)
-            # create item
+        # datasets are listed in the catalogue
+        for row in get_index().select(self.catalogue, emsc=self.emsc,
+                                      gcm=self.gcm, year=self.year):
+            yield self.createItem(row['emsc'], row['gcm'], row['year'])
         # yield current as well
         if self.current_file and (not self.year or 'current' in self.year):
             yield self.createCurrentItem()
 
     def createCurrentItem(self):
-        description = "Australia, current climate baseline of 1976 to 2005 - climate of 1990 - generated from aggregating monthly data from Australia Water Availability Project (AWAP; http://www.bom.gov.au/jsp/awap/). " \
-                      "These data were then aggregated to Bioclim variables according to the methodology of WorldClim www.worldclim.org/methods. " \
-                      "For the gridded Australian data sets which are 1-kilometer in resolution, the base layers (i.e. daily AWAP 5k grids) are the same as they are in the 5-kilometer resolution dataset. " \
-                      "The difference is that the final product (i.e. the aggregated data in the form of a Bioclim variable) is interpolated from 5k res to 1k res."
         item = {
             "_path": "datasets/climate/{0}/{1}".format(self.folder, self.current_file),
             "_owner": (1, 'admin'),
             "_type": "org.bccvl.content.remotedataset",
             "title": self.current_title,
-            "description": description,
+            "description": self.current_description,
             "remoteUrl": "{0}/{1}/{2}".format(SWIFTROOT, self.swiftcontainer, self.current_file),
             "format": "application/zip",
             "creators": "BCCVL",
@@ -288,6 +1473,7 @@ class FutureClimateLayer5k(object):
 @implementer(ISection)
 class FutureClimateLayer1k(FutureClimateLayer5k):
 
+    catalogue = 'a1ksource'
     resolution = 'Resolution30s'
     swiftcontainer = 'australia_1km'
     folder = 'australia/australia_1km'
@@ -301,6 +1487,7 @@ class FutureClimateLayer1k(FutureClimateLayer5k):
 @implementer(ISection)
 class FutureClimateLayer250m(FutureClimateLayer5k):
 
+    catalogue = 'a250source'
     resolution = 'Resolution9s'
     swiftcontainer = 'australia_250m'
     folder = 'australia/australia_250m'
@@ -656,15 +1843,12 @@ class AWAPLayers(object):
         if not self.enabled:
             return
 
-        # datasets for years 1900 to 2011
+        # datasets for years 1900 to 2010
         IAnnotations(self.context.REQUEST)['org.bccvl.site.stats.delay'] = True
 
-        # datasets for years 1900 to 2011
-        for year in range(1900, 2011):
-            if self.year and str(year) not in self.year:
-                # skip item if not selected
-                continue
-
+        # datasets for years 1900 to 2010
+        for row in get_index().select('awapsource', year=self.year):
+            year = int(row['year'])
             # TODO: maybe put some info in here? to access in a later stage...
             #       bccvlmetadata.json may be an option here
             opt = {
@@ -1079,6 +2263,18 @@ class GlobalMarineFutureLayers(GlobalMarineLayer):
 
     """
     COMMON_DESC_TEXT = " based on an average of three coupled atmosphere-ocean general circulation models (CCSM4, HadGEM2-ES, MIROC5)."
+    # time period for each year
+    periods = {
+        '2050': '2040-2050',
+        '2100': '2090-2100',
+    }
+    # map emscs from file name to title and vocabulary id
+    scenarios = {
+        'RCP26': ('RCP 2.6', 'RCP3PD'),
+        'RCP45': ('RCP 4.5', 'RCP45'),
+        'RCP60': ('RCP 6.0', 'RCP6'),
+        'RCP85': ('RCP 8.5', 'RCP85'),
+    }
 
     def __iter__(self):
         # exhaust previous
@@ -1091,53 +2287,50 @@ class GlobalMarineFutureLayers(GlobalMarineLayer):
         # tell our event stats event handler that we collect stats later
         IAnnotations(self.context.REQUEST)['org.bccvl.site.stats.delay'] = True
 
-        for year, period in [('2050', '2040-2050'), ('2100', '2090-2100')]:
-            for emsc, scenario, emsc_vocab in [('RCP26', 'RCP 2.6', 'RCP3PD'), ('RCP45', 'RCP 4.5', 'RCP45'), ('RCP60', 'RCP 6.0', 'RCP6'), ('RCP85', 'RCP 8.5', 'RCP85')]:
-                if self.year and year not in self.year:
-                    # skip this year
-                    continue
-                if self.emsc and emsc not in self.emsc:
-                    # skip this emission scenario
-                    continue
-
-                for filename, category, title, description, full_description in (
-                        ('GlobalMarineSurfaceData.{0}.{1}.zip'.format(year, emsc),
-                         'physical',
-                         'Global Marine Surface Data, {0}, {1}, 5 arcmin (~10 km)'.format(period, scenario),
-                         'Global data for sea surface temperature, salinity, current velocity, and ice thickness for future time period {0} for emission scenario {1}'.format(period, scenario),
-                         'This future dataset includes 6 layers (minimum, maximum, mean, range, long term minimum and long term maximum) for each of 4 different variables: 1) sea surface temperature: the temperature of the topmost meter of the ocean water column, 2) salinity: the dissolved salt content in the ocean surface, 3) current velocity: measurements of current speeds at the ocean surface, 4) ice thickness: in metres at the ocean surface. '
-                        ),
-                        ):
-                    # TODO: maybe put some info in here? to access in a later stage...
-                    #       bccvlmetadata.json may be an option here
-                    opt = {
-                        'id': filename,
-                        'url': '{0}/global_marine/{1}'.format(SWIFTROOT, filename),
-                    }
-                    item = {
-                        "_path": 'datasets/environmental/global_marine/{0}'.format(opt['id']),
-                        "_owner":  (1,  'admin'),
-                        "_type": "org.bccvl.content.remotedataset",
-                        "title": title,
-                        "description": description + self.COMMON_DESC_TEXT,
-                        "external_description": full_description + self.COMMON_FULL_DESC,
-                        "remoteUrl": opt['url'],
-                        "format": "application/zip",
-                        "creators": 'BCCVL',
-                        "dataSource": "ingest",
-                        "_transitions": "publish",
-                        "subject": [MARINE_DATASET_TAG, FUTURE_DATASET_TAG],
-                        "bccvlmetadata": {
-                            "genre": "DataGenreE",
-                            "resolution": 'Resolution5m',
-                            "categories": [category],
-                            "emsc": emsc_vocab,
-                            "gcm": 'CCSM4, HadGEM2-ES, MIROC5',
-                            "year": year,
-                        },
-                    }
-                    LOG.info('Import %s', item['title'])
-                    yield item
+        for row in get_index().select('futureglobalmarinesource',
+                                      emsc=self.emsc, year=self.year):
+            year, emsc = row['year'], row['emsc']
+            period = self.periods[year]
+            scenario, emsc_vocab = self.scenarios[emsc]
+
+            for filename, category, title, description, full_description in (
+                    ('GlobalMarineSurfaceData.{0}.{1}.zip'.format(year, emsc),
+                     'physical',
+                     'Global Marine Surface Data, {0}, {1}, 5 arcmin (~10 km)'.format(period, scenario),
+                     'Global data for sea surface temperature, salinity, current velocity, and ice thickness for future time period {0} for emission scenario {1}'.format(period, scenario),
+                     'This future dataset includes 6 layers (minimum, maximum, mean, range, long term minimum and long term maximum) for each of 4 different variables: 1) sea surface temperature: the temperature of the topmost meter of the ocean water column, 2) salinity: the dissolved salt content in the ocean surface, 3) current velocity: measurements of current speeds at the ocean surface, 4) ice thickness: in metres at the ocean surface. '
+                    ),
+                    ):
+                # TODO: maybe put some info in here? to access in a later stage...
+                #       bccvlmetadata.json may be an option here
+                opt = {
+                    'id': filename,
+                    'url': '{0}/global_marine/{1}'.format(SWIFTROOT, filename),
+                }
+                item = {
+                    "_path": 'datasets/environmental/global_marine/{0}'.format(opt['id']),
+                    "_owner":  (1,  'admin'),
+                    "_type": "org.bccvl.content.remotedataset",
+                    "title": title,
+                    "description": description + self.COMMON_DESC_TEXT,
+                    "external_description": full_description + self.COMMON_FULL_DESC,
+                    "remoteUrl": opt['url'],
+                    "format": "application/zip",
+                    "creators": 'BCCVL',
+                    "dataSource": "ingest",
+                    "_transitions": "publish",
+                    "subject": [MARINE_DATASET_TAG, FUTURE_DATASET_TAG],
+                    "bccvlmetadata": {
+                        "genre": "DataGenreE",
+                        "resolution": 'Resolution5m',
+                        "categories": [category],
+                        "emsc": emsc_vocab,
+                        "gcm": 'CCSM4, HadGEM2-ES, MIROC5',
+                        "year": year,
+                    },
+                }
+                LOG.info('Import %s', item['title'])
+                yield item
             
 
 class WorldClimLayer(object):
@@ -1158,67 +2351,42 @@ class WorldClimLayer(object):
                        for x in options.get('gcm', "").split(',') if x)
         self.year = set(x.strip()
                         for x in options.get('year', "").split(',') if x)
+        self.resolution = set(x.strip()
+                              for x in options.get('resolution', "").split(',') if x)
 
 
 @provider(ISectionBlueprint)
 @implementer(ISection)
 class WorldClimFutureLayers(WorldClimLayer):
 
-    def datasets(self):
-        MODELS = {
-            'ACCESS1-0': ['RCP4.5', 'RCP8.5'],
-            'BCC-CSM1-1': ['RCP3PD', 'RCP4.5', 'RCP6', 'RCP8.5'],
-            'CCSM4': ['RCP3PD', 'RCP4.5', 'RCP6', 'RCP8.5'],
-            'CESM1-CAM5-1-FV2': ['RCP4.5'],
-            'CNRM-CM5': ['RCP3PD', 'RCP4.5', 'RCP8.5'],
-            'GFDL-CM3': ['RCP3PD', 'RCP4.5', 'RCP8.5'],
-            'GFDL-ESM2G': ['RCP3PD', 'RCP4.5', 'RCP6'],
-            'GISS-E2-R': ['RCP3PD', 'RCP4.5', 'RCP6', 'RCP8.5'],
-            'HadGEM2-A0': ['RCP3PD', 'RCP4.5', 'RCP6', 'RCP8.5'],
-            'HadGEM2-CC': ['RCP4.5', 'RCP8.5'],
-            'HadGEM2-ES': ['RCP3PD', 'RCP4.5', 'RCP6', 'RCP8.5'],
-            'INMCM4': ['RCP4.5', 'RCP8.5'],
-            'IPSL-CM5A-LR': ['RCP3PD', 'RCP4.5', 'RCP6', 'RCP8.5'],
-            'MIROC-ESM-CHEM': ['RCP3PD', 'RCP4.5', 'RCP6', 'RCP8.5'],
-            'MIROC-ESM': ['RCP3PD', 'RCP4.5', 'RCP6', 'RCP8.5'],
-            'MIROC5': ['RCP3PD', 'RCP4.5', 'RCP6', 'RCP8.5'],
-            'MPI-ESM-LR': ['RCP3PD', 'RCP4.5', 'RCP8.5'],
-            'MRI-CGCM3': ['RCP3PD', 'RCP4.5', 'RCP6', 'RCP8.5'],
-            'NorESM1-M': ['RCP3PD', 'RCP4.5', 'RCP6', 'RCP8.5'],
-        }
-        YEARS = ['2050', '2070']
-        RESOS = {
-            # '30s': '30 arcsec', # TODO: 30s are 12+GB, need to resolve
-            '2.5m': '2.5 arcmin',
-            '5m': '5 arcmin',
-            '10m': '10 arcmin',
-        }
-        LAYERS = ['bioclim', 'prec', 'tmin', 'tmax']
+    # display names for resolutions
+    resolutions = {
+        # '30s': '30 arcsec', # TODO: 30s are 12+GB, need to resolve
+        '2.5m': '2.5 arcmin',
+        '5m': '5 arcmin',
+        '10m': '10 arcmin',
+    }
 
-        for gcm, year, res, layer in product(MODELS, YEARS, RESOS, LAYERS):
-            if self.gcm and gcm not in self.gcm:
-                # skip this gcm
-                continue
-            if self.year and year not in self.year:
-                # skip this year
-                continue
-            for emsc in MODELS[gcm]:
-                if self.emsc and emsc not in self.emsc:
-                    # skip
-                    continue
-                filename = '{}_{}_{}_{}_{}.zip'.format(
-                    gcm, emsc, year, res, layer)
-                monthly_tag = None
-                if layer == 'bioclim':
-                    title = u'WorldClim, future projection using {} {}, {} ({})'.format(
-                        gcm, emsc_title(self.context, emsc.replace('.', '')), RESOS[res], year)
-                else:
-                    title = u'WorldClim, future projection monthly {} using {} {}, {} ({})'.format(
-                        layer, gcm, emsc_title(self.context, emsc.replace('.', '')), RESOS[res], year)
-                    monthly_tag = MONTHLY_DATASET_TAG
-                if emsc == 'ccsm4':
-                    emsc = 'ncar-ccsm40'
-                yield filename, title, res.replace('.', '_'), year, gcm.lower(), emsc.replace('.', ''), monthly_tag
+    def datasets(self):
+        rows = get_index().select('wcfsource', gcm=self.gcm, year=self.year,
+                                  emsc=self.emsc, resolution=self.resolution)
+        for row in rows:
+            gcm, emsc, year = row['gcm'], row['emsc'], row['year']
+            res, layer = row['resolution'], row['layer']
+            filename = '{}_{}_{}_{}_{}.zip'.format(
+                gcm, emsc, year, res, layer)
+            monthly_tag = None
+            emsctitle = emsc_title(self.context, emsc.replace('.', ''))
+            if layer == 'bioclim':
+                title = u'WorldClim, future projection using {} {}, {} ({})'.format(
+                    gcm, emsctitle, self.resolutions[res], year)
+            else:
+                title = u'WorldClim, future projection monthly {} using {} {}, {} ({})'.format(
+                    layer, gcm, emsctitle, self.resolutions[res], year)
+                monthly_tag = MONTHLY_DATASET_TAG
+            if emsc == 'ccsm4':
+                emsc = 'ncar-ccsm40'
+            yield filename, title, res.replace('.', '_'), year, gcm.lower(), emsc.replace('.', ''), monthly_tag
 
     def __iter__(self):
         # exhaust previous
@@ -1247,7 +2415,8 @@ class WorldClimFutureLayers(WorldClimLayer):
             "creators": 'BCCVL',
             "dataSource": "ingest",
             "_transitions": "publish",
-            "subject": [TERRESTRIAL_DATASET_TAG, FUTURE_DATASET_TAG],
+            "subject": [TERRESTRIAL_DATASET_TAG, FUTURE_DATASET_TAG] + (
+                [tag] if tag else []),
             "bccvlmetadata": {
                 "genre": "DataGenreFC",
                 "resolution": 'Resolution{}'.format(res),
@@ -1258,8 +2427,6 @@ class WorldClimFutureLayers(WorldClimLayer):
             },
             "downloadable": False,
         }
-        if tag:
-            item['subject'] += [tag]
         return item
 
 
@@ -1320,12 +2487,10 @@ class WorldClimCurrentLayers(WorldClimLayer):
             "bccvlmetadata": {
                 "genre": "DataGenreCC",
                 "resolution": 'Resolution{}'.format(res),
-                "categories": ["climate"],
+                "categories": ["topography" if layer == 'alt' else "climate"],
             },
             "downloadable": False,
         }
-        if layer == 'alt':
-            item['bccvlmetadata']['categories'] = ['topography']
         LOG.info('Import %s', item['title'])
         return item
 
@@ -1557,7 +2722,7 @@ class FPARLayers(object):
                 item['title'] = 'Australia, MODIS-fPAR time series (2000-2014), 9 arcsec (~250 m)'
                 item['description'] = "Data aggregated over years 2000 to 2014 (Average, Minimum, Maximum, Coefficient of Variation)".format(
                     year=dfile.split(".")[1])
-                item['subject'].append(SUMMARY_DATASET_TAG)
+                item['subject'] = item['subject'] + [SUMMARY_DATASET_TAG]
             # Growing year (Jul - Jun)
             elif len(dfile) == 29:
                 year1 = dfile.split(".")[1].split("-")[0]
@@ -1736,12 +2901,13 @@ class TASClimLayers(WorldClimLayer):
         res = "6m"
         filename = 'TASCLIM_{emsc}_{gcm}_{year}.zip'.format(
             emsc=emsc, gcm=gcm, year=year)
+        emsctitle = emsc_title(self.context, self.emscs[emsc])
         item = {
             '_path': 'datasets/climate/tasclim/{}/{}'.format(res, filename),
             '_owner': (1, 'admin'),
             "_type": "org.bccvl.content.remotedataset",
             "title": u'Tasmania, climate futures Tasmania, ({year}),  (CFT) ({emsc}) based on {gcm}, 6 arcmin (~12 km)'.format(
-                emsc=emsc_title(self.context, self.emscs[emsc]), gcm=gcm.upper(), year=year),
+                emsc=emsctitle, gcm=gcm.upper(), year=year),
             "description": u"Climate Futures Tasmania (CFT) Bioclimate Map Time-Series, 1980 - 2085. A set of 19 bioclimatic variables (30-year average) with 6 arcminute resolution, calculated according to the WorldClim method.",
             "remoteUrl": '{0}/tasclim/{1}'.format(SWIFTROOT, filename),
             "format": "application/zip",
@@ -1762,7 +2928,7 @@ class TASClimLayers(WorldClimLayer):
         # Set category to current for year <= 2015
         if year <= 2015:
             item["title"] = u'Tasmania, Current Climate ({year}), ({emsc}) based on {gcm}, 6 arcmin (~12 km)'.format(
-                emsc=emsc_title(self.context, self.emscs[emsc]), gcm=gcm.upper(), year=year)
+                emsc=emsctitle, gcm=gcm.upper(), year=year)
             item["subject"] = [TERRESTRIAL_DATASET_TAG, CURRENT_DATASET_TAG]
             item["bccvlmetadata"] = {
                 "genre": "DataGenreCC",
@@ -2107,6 +3273,14 @@ class GeofabricLayers(WorldClimLayer):
             u'Data source: <a href=\"https://data.gov.au/dataset/national-environmental-stream-attributes-v1-1-5\" target=\"_blank\">https://data.gov.au/dataset/national-environmental-stream-attributes-v1-1-5</a>'
     ]
 
+    # joined once for all items
+    full_external_description = u'<br>'.join(external_description)
+    rdi_full_external_description = u'<br>'.join(rdi_external_description)
+    climate_stream_full_external_description = u'<br>'.join(
+        climate_stream_external_description)
+    climate_catchment_full_external_description = u'<br>'.join(
+        climate_catchment_external_description)
+
     # Geofabric datasets
     def __init__(self, transmogrifier, name, options, previous):
         self.transmogrifier = transmogrifier
@@ -2163,13 +3337,13 @@ class GeofabricLayers(WorldClimLayer):
 
         if dstype == 'rdi':
             title = u'Freshwater Data (Australia), {attrname}, 9 arcsec (~250m)'.format(attrname=attrname)
-            full_description = u'<br>'.join(self.rdi_external_description)
+            full_description = self.rdi_full_external_description
         elif dstype == 'climate':
             title = u'Freshwater {btype} Data (Australia), {attrname}, 9 arcsec (~250m)'.format(btype=boundtype.title(), attrname=attrname)
-            full_description = u'<br>'.join(self.climate_stream_external_description if boundtype == 'stream' else self.climate_catchment_external_description)
+            full_description = self.climate_stream_full_external_description if boundtype == 'stream' else self.climate_catchment_full_external_description
         else:
             title = u'Freshwater {btype} Data (Australia), {attrname}, 9 arcsec (~250m)'.format(btype=boundtype.title(), attrname=attrname)
-            full_description = u'<br>'.join(self.external_description)
+            full_description = self.full_external_description
 
 
         item = {
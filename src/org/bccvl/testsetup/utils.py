@@ -0,0 +1,59 @@
+""" Helpers shared by the zopectl commands
+"""
+import logging
+import sys
+
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManager import setSecurityPolicy
+from AccessControl.SpecialUsers import system
+from Products.CMFCore.tests.base.security import PermissiveSecurityPolicy, OmnipotentUser
+from Testing.makerequest import makerequest
+try:
+    from zope.component.hooks import site
+except ImportError:
+    # we have an older zope.compenents:
+    import contextlib
+    from zope.component.hooks import getSite, setSite
+
+    @contextlib.contextmanager
+    def site(site):
+        old_site = getSite()
+        setSite(site)
+        try:
+            yield
+        finally:
+            setSite(old_site)
+
+
+def setup_logging():
+    """Log INFO and above to stdout; safe to call more than once"""
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+
+    if not getattr(setup_logging, 'handler', None):
+        handler = logging.StreamHandler(sys.stdout)
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+        handler.setFormatter(formatter)
+        root_logger.addHandler(handler)
+        setup_logging.handler = handler
+
+    logging.getLogger('ZODB.Connection').setLevel(logging.WARN)
+
+
+def spoofRequest(app):
+    """
+    Make REQUEST variable to be available on the Zope application server.
+
+    This allows acquisition to work properly
+    """
+    _policy = PermissiveSecurityPolicy()
+    _oldpolicy = setSecurityPolicy(_policy)
+    newSecurityManager(None, OmnipotentUser().__of__(app.acl_users))
+    return makerequest(app)
+
+
+def prepare_app(app):
+    """Return app wrapped in a request, running as system user"""
+    app = spoofRequest(app)
+    newSecurityManager(None, system)
+    return app
@@ -0,0 +1,221 @@
+""" Inspect remote zip files with HTTP range requests
+
+Only the tail of the file with the end of central directory record and
+the central directory itself is fetched, plus single members if their
+content is needed. Zip64 archives are supported.
+"""
+import json
+import struct
+import zlib
+
+
+# end of central directory record; max comment length is 64k
+EOCD = struct.Struct('<4s4H2LH')
+EOCD_SIG = b'PK\x05\x06'
+ZIP64_LOCATOR = struct.Struct('<4sLQL')
+ZIP64_LOCATOR_SIG = b'PK\x06\x07'
+ZIP64_EOCD = struct.Struct('<4sQ2H2L4Q')
+ZIP64_EOCD_SIG = b'PK\x06\x06'
+CENTRAL_DIR = struct.Struct('<4s6H3L5H2L')
+CENTRAL_DIR_SIG = b'PK\x01\x02'
+LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+LOCAL_HEADER_SIG = b'PK\x03\x04'
+
+TAIL_SIZE = EOCD.size + 0xffff + ZIP64_LOCATOR.size
+
+# file name of the metadata bundled with bccvl datasets
+METADATA_FILE = 'bccvl/metadata.json'
+
+
+class ZipProbeError(Exception):
+    pass
+
+
+def fetch_range(client, url, start, end=None):
+    """Return (data, total size) for byte range start to end (inclusive)
+
+    A negative start without end fetches the last -start bytes.
+    """
+    if start < 0:
+        byterange = 'bytes={0}'.format(start)
+    else:
+        byterange = 'bytes={0}-{1}'.format(start, '' if end is None else end)
+    response = client.request('GET', url, {'Range': byterange})
+    if response.status == 200:
+        # server ignored the range, or range covers the whole file
+        data = response.body
+        total = len(data)
+        if start < 0:
+            data = data[start:]
+        else:
+            data = data[start:None if end is None else end + 1]
+        return data, total
+    if response.status != 206:
+        raise ZipProbeError('{0}: range request failed with {1}'.format(
+            url, response.status))
+    contentrange = response.headers.get('content-range', '')
+    try:
+        total = int(contentrange.rsplit('/', 1)[1])
+    except (IndexError, ValueError):
+        raise ZipProbeError('{0}: bad Content-Range {1!r}'.format(url, contentrange))
+    return response.body, total
+
+
+def _zip64_extra(extra, sizes):
+    """Replace values of 0xffffffff in sizes with those from a zip64 extra field
+
+    sizes is the list [uncompressed size, compressed size, offset].
+    """
+    pos = 0
+    while pos + 4 <= len(extra):
+        headerid, length = struct.unpack('<2H', extra[pos:pos + 4])
+        if headerid == 1:
+            data = extra[pos + 4:pos + 4 + length]
+            idx = 0
+            for num in range(len(sizes)):
+                if sizes[num] == 0xffffffff:
+                    sizes[num] = struct.unpack('<Q', data[idx:idx + 8])[0]
+                    idx += 8
+            break
+        pos += 4 + length
+    return sizes
+
+
+def parse_central_directory(data, count):
+    """Return list of member dicts from raw central directory data"""
+    members = []
+    pos = 0
+    for num in range(count):
+        header = CENTRAL_DIR.unpack(data[pos:pos + CENTRAL_DIR.size])
+        if header[0] != CENTRAL_DIR_SIG:
+            raise ZipProbeError('bad central directory entry {0}'.format(num))
+        (method, crc, csize, usize, namelen, extralen, commentlen) = (
+            header[4], header[7], header[8], header[9], header[10],
+            header[11], header[12])
+        offset = header[16]
+        pos += CENTRAL_DIR.size
+        name = data[pos:pos + namelen]
+        extra = data[pos + namelen:pos + namelen + extralen]
+        pos += namelen + extralen + commentlen
+        usize, csize, offset = _zip64_extra(extra, [usize, csize, offset])
+        if header[3] & 0x800:
+            name = name.decode('utf-8')
+        else:
+            name = name.decode('cp437')
+        members.append({
+            'filename': name,
+            'size': usize,
+            'compressed_size': csize,
+            'method': method,
+            'crc': crc,
+            'offset': offset,
+        })
+    return members
+
+
+def list_members(client, url):
+    """Return list of members of the zip file at url
+
+    Each member is a dict with filename, size, compressed_size, method,
+    crc and offset of its local header.
+    """
+    tail, total = fetch_range(client, url, -TAIL_SIZE)
+    tailstart = total - len(tail)
+    pos = tail.rfind(EOCD_SIG)
+    if pos < 0:
+        raise ZipProbeError('{0}: not a zip file'.format(url))
+    eocd = EOCD.unpack(tail[pos:pos + EOCD.size])
+    count, cdsize, cdoffset = eocd[4], eocd[5], eocd[6]
+
+    locpos = pos - ZIP64_LOCATOR.size
+    if locpos >= 0 and tail[locpos:locpos + 4] == ZIP64_LOCATOR_SIG:
+        zip64offset = ZIP64_LOCATOR.unpack(tail[locpos:pos])[2]
+        if zip64offset >= tailstart:
+            record = tail[zip64offset - tailstart:][:ZIP64_EOCD.size]
+        else:
+            record = fetch_range(client, url, zip64offset,
+                                 zip64offset + ZIP64_EOCD.size - 1)[0]
+        zip64 = ZIP64_EOCD.unpack(record)
+        if zip64[0] != ZIP64_EOCD_SIG:
+            raise ZipProbeError('{0}: bad zip64 end of central directory'.format(url))
+        count, cdsize, cdoffset = zip64[7], zip64[8], zip64[9]
+
+    if cdoffset >= tailstart:
+        data = tail[cdoffset - tailstart:cdoffset - tailstart + cdsize]
+    else:
+        data = fetch_range(client, url, cdoffset, cdoffset + cdsize - 1)[0]
+    return parse_central_directory(data, count)
+
+
+def read_member(client, url, member):
+    """Return content of member of the zip file at url"""
+    # the local header has its own, possibly different, extra field;
+    # fetch enough to cover name and some extra data in one go
+    start = member['offset']
+    guess = LOCAL_HEADER.size + len(member['filename'].encode('utf-8')) + 256
+    data = fetch_range(client, url, start,
+                       start + guess + member['compressed_size'] - 1)[0]
+    header = LOCAL_HEADER.unpack(data[:LOCAL_HEADER.size])
+    if header[0] != LOCAL_HEADER_SIG:
+        raise ZipProbeError('{0}: bad local header for {1}'.format(
+            url, member['filename']))
+    datastart = LOCAL_HEADER.size + header[9] + header[10]
+    dataend = datastart + member['compressed_size']
+    if dataend > len(data):
+        data += fetch_range(client, url, start + len(data), start + dataend - 1)[0]
+    content = data[datastart:dataend]
+    if member['method'] == 8:
+        content = zlib.decompressobj(-15).decompress(content)
+    elif member['method'] != 0:
+        raise ZipProbeError('{0}: unsupported compression {1} for {2}'.format(
+            url, member['method'], member['filename']))
+    return content
+
+
+def probe(client, url):
+    """Return members and bundled bccvl metadata of the zip file at url
+
+    The result is a dict with 'files' mapping file names to their size,
+    and 'metadata', the parsed bccvl/metadata.json if the zip has one.
+    """
+    members = list_members(client, url)
+    result = {
+        'files': dict((member['filename'], member['size'])
+                      for member in members
+                      if not member['filename'].endswith('/')),
+        'metadata': None,
+    }
+    for member in members:
+        if member['filename'].endswith(METADATA_FILE):
+            result['metadata'] = json.loads(
+                read_member(client, url, member).decode('utf-8'))
+            break
+    return result
+
+
+def layers_from_metadata(metadata, files):
+    """Return layer listing from bundled metadata
+
+    Bundled metadata lists files in the zip (relative to its top folder)
+    with their layer and type; the result maps layer ids to filename
+    within the zip, datatype and size.
+    """
+    layers = {}
+    if not metadata:
+        return layers
+    for name, info in (metadata.get('files') or {}).items():
+        if not info.get('layer'):
+            continue
+        # names in the metadata are relative to the folder containing bccvl/
+        filename = name
+        for path in files:
+            if path == name or path.endswith('/' + name):
+                filename = path
+                break
+        layers[info['layer']] = {
+            'filename': filename,
+            'datatype': info.get('type'),
+            'layer': info['layer'],
+            'size': files.get(filename),
+        }
+    return layers